@@ -0,0 +1,89 @@
+"""Compare the aggregation methods of gradients across towers on AlexNet.
+
+Builds ``alexnet_tfutils`` once for the variables, then uses one random
+gradient per variable and tower (CPU towers by default), and averages them
+with ``MinibatchOptimizer.aggregate_gradients``. For each method, reports
+the number of ops the aggregation adds to the graph, the time to build
+them and the time of a run computing the averaged gradients.
+
+    python benchmarks/aggregation_benchmark.py --num_towers 2 3 4
+
+"""
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import argparse
+
+import tensorflow as tf
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+from tfutils.model import alexnet_tfutils
+from tfutils.optimizer import MinibatchOptimizer
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Benchmark gradient aggregation across towers')
+    parser.add_argument(
+            '--num_towers', default=[2, 3, 4], type=int, nargs='+', action='store',
+            help='Numbers of towers to benchmark')
+    parser.add_argument(
+            '--bucket_size', default=[0, 1024 * 1024, 4 * 1024 * 1024], type=int, nargs='+',
+            action='store', help='Bucket sizes of the fused method, 0 for none')
+    parser.add_argument(
+            '--device', default='/cpu:0', type=str, action='store',
+            help='Device of the towers gradients')
+    parser.add_argument(
+            '--repeats', default=10, type=int, action='store',
+            help='Number of timed runs, the best one is reported')
+    return parser
+
+
+def benchmark(num_towers, method, bucket_size, device, repeats):
+    with tf.Graph().as_default():
+        images = tf.zeros([1, 224, 224, 3])
+        alexnet_tfutils({'images': images}, train=True)
+        tower_grads = []
+        for tower in range(num_towers):
+            with tf.device(device), tf.name_scope('tower_%d' % tower):
+                tower_grads.append(
+                        [(tf.Variable(tf.random_normal(var.shape), trainable=False), var)
+                         for var in tf.trainable_variables()])
+
+        num_ops = len(tf.get_default_graph().get_operations())
+        start = time.time()
+        grads = MinibatchOptimizer.aggregate_gradients(
+                tower_grads, method=method, bucket_size=bucket_size)
+        build_time = time.time() - start
+        num_ops = len(tf.get_default_graph().get_operations()) - num_ops
+        # Fetch one element of each gradient, tf.group of them gets pruned
+        aggregate = [tf.reshape(grad, [-1])[:1] for grad, _ in grads if grad is not None]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(aggregate)
+            run_times = []
+            for _ in range(repeats):
+                start = time.time()
+                sess.run(aggregate)
+                run_times.append(time.time() - start)
+    return num_ops, build_time, min(run_times)
+
+
+def main():
+    args = get_parser().parse_args()
+    methods = [('average', None)] + [('fused', bucket_size or None)
+                                     for bucket_size in args.bucket_size]
+    print('%6s %-16s %8s %10s %10s' % ('towers', 'method', 'ops', 'build (s)', 'run (ms)'))
+    for num_towers in args.num_towers:
+        for method, bucket_size in methods:
+            num_ops, build_time, run_time = benchmark(
+                    num_towers, method, bucket_size, args.device, args.repeats)
+            name = method if bucket_size is None else '%s/%d' % (method, bucket_size)
+            print('%6d %-16s %8d %10.3f %10.1f' % (
+                  num_towers, name, num_ops, build_time, 1000 * run_time))
+
+
+if __name__ == '__main__':
+    main()
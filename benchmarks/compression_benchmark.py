@@ -0,0 +1,122 @@
+"""Compare the checkpoint compression codecs on AlexNet weights.
+
+Tars an AlexNet checkpoint the way DBInterface uploads it and reports, for
+every available codec, the compression ratio and the compression and
+decompression throughput (in MB/s of uncompressed data).
+
+Freshly initialized weights are close to incompressible, so pass the
+checkpoint of a trained model (for instance one written by
+tutorials/train_alexnet.py) with --checkpoint for representative numbers:
+
+    python benchmarks/compression_benchmark.py --checkpoint /path/to/model.ckpt-100000
+
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import glob
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+import cStringIO
+
+import tensorflow as tf
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+from tfutils import model_tool
+from tfutils.compression import available_codecs, CompressingWriter, \
+        DecompressingReader, CHUNK_SIZE
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the checkpoint compression codecs')
+    parser.add_argument(
+            '--checkpoint', default=None, type=str, action='store',
+            help='Prefix of a V2 checkpoint to use instead of random AlexNet weights')
+    parser.add_argument(
+            '--codecs', default=None, type=str, action='store',
+            help='Comma separated codecs to compare, all available ones by default')
+    parser.add_argument(
+            '--levels', default=None, type=str, action='store',
+            help='Comma separated compression levels, the codec default by default')
+    return parser
+
+
+def save_alexnet(save_dir):
+    """Save randomly initialized AlexNet weights, return the checkpoint prefix."""
+    with tf.Graph().as_default():
+        images = tf.placeholder(tf.float32, [1, 224, 224, 3])
+        model_tool.alexnet(images, train=False)
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            return saver.save(sess, os.path.join(save_dir, 'alexnet.ckpt'))
+
+
+def tar_checkpoint(prefix):
+    files = sorted(glob.glob(prefix + '.index') + glob.glob(prefix + '.data-*'))
+    assert files, 'No V2 checkpoint files for %s' % prefix
+    buf = cStringIO.StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w|')
+    for _f in files:
+        tar.add(_f, arcname=os.path.basename(_f))
+    tar.close()
+    return buf.getvalue()
+
+
+def run_codec(data, codec, level):
+    dest = cStringIO.StringIO()
+    start = time.time()
+    writer = CompressingWriter(dest, codec, level)
+    for offset in xrange(0, len(data), CHUNK_SIZE):
+        writer.write(data[offset:offset + CHUNK_SIZE])
+    writer.close()
+    compress_time = time.time() - start
+
+    start = time.time()
+    reader = DecompressingReader(cStringIO.StringIO(dest.getvalue()), codec)
+    size = 0
+    while True:
+        chunk = reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+    decompress_time = time.time() - start
+    assert size == len(data)
+    return writer.compressed_size, compress_time, decompress_time
+
+
+def main():
+    args = get_parser().parse_args()
+    save_dir = None
+    if args.checkpoint is None:
+        save_dir = tempfile.mkdtemp()
+        prefix = save_alexnet(save_dir)
+    else:
+        prefix = args.checkpoint
+    try:
+        data = tar_checkpoint(prefix)
+    finally:
+        if save_dir is not None:
+            shutil.rmtree(save_dir)
+
+    codecs = args.codecs.split(',') if args.codecs else available_codecs()
+    levels = [int(_l) for _l in args.levels.split(',')] if args.levels else [None]
+    megabytes = len(data) / 1024 ** 2
+    print('Checkpoint tarball: %.1f MB' % megabytes)
+    print('%-6s %5s %7s %14s %16s' % ('codec', 'level', 'ratio',
+                                      'compress MB/s', 'decompress MB/s'))
+    for codec in codecs:
+        for level in levels:
+            size, compress_time, decompress_time = run_codec(data, codec, level)
+            print('%-6s %5s %7.3f %14.1f %16.1f' % (
+                codec, 'def' if level is None else level, len(data) / size,
+                megabytes / compress_time, megabytes / decompress_time))
+
+
+if __name__ == '__main__':
+    main()
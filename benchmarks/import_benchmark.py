@@ -0,0 +1,60 @@
+"""Time the import of the tfutils entry points in fresh interpreters.
+
+Each statement runs in a new python process, so nothing is cached between
+measurements. The heavy dependencies loaded by each import are listed to
+catch imports that stopped being lazy.
+
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = ['import tfutils',
+              'from tfutils import model',
+              'import tfutils.utils',
+              'import tfutils.imagenet_data',
+              'from tfutils import base']
+
+HEAVY = ['tensorflow', 'pymongo', 'gridfs', 'git', 'pkg_resources',
+         'tfutils.model_tool', 'tfutils.model_tool_old', 'tfutils.db_interface']
+
+CODE = """import time
+start = time.time()
+%s
+duration = time.time() - start
+import sys
+print(repr((duration, [m for m in %r if m in sys.modules])))
+"""
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the import time of tfutils')
+    parser.add_argument(
+            '--repeats', default=5, type=int, action='store',
+            help='Number of processes per statement, the best one is reported')
+    return parser
+
+
+def time_import(statement):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+            [sys.executable, '-c', CODE % (statement, HEAVY)], env=env)
+    return eval(output.strip().splitlines()[-1])
+
+
+def main():
+    args = get_parser().parse_args()
+    print('%-32s %8s  %s' % ('statement', 'seconds', 'heavy modules loaded'))
+    for statement in STATEMENTS:
+        runs = [time_import(statement) for _ in range(args.repeats)]
+        duration = min(_r[0] for _r in runs)
+        print('%-32s %8.3f  %s' % (statement, duration, ', '.join(runs[0][1]) or '-'))
+
+
+if __name__ == '__main__':
+    main()
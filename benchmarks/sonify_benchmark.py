@@ -0,0 +1,90 @@
+"""Time sonify and BSON encoding of per-example validation results.
+
+Validation targets such as ``top1`` from ``tf.nn.in_top_k`` return one
+value per example, so a record of an ImageNet-sized validation holds arrays
+of tens of thousands of values. This compares sonify on such results with
+the element by element conversion it used to do, and shows the record size
+once arrays above gfs_array_threshold are left out.
+
+"""
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import argparse
+
+import numpy as np
+import bson
+
+sys.path.insert(0, '.')
+sys.path.insert(0, '..')
+from tfutils.db_interface import sonify
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Benchmark sonify on validation results')
+    parser.add_argument(
+            '--num_examples', default=50000, type=int, action='store',
+            help='Number of examples in the validation results')
+    parser.add_argument(
+            '--repeats', default=3, type=int, action='store',
+            help='Number of timed runs, the best one is reported')
+    parser.add_argument(
+            '--gfs_array_threshold', default=64 * 1024, type=int, action='store',
+            help='Size in bytes above which arrays are left out of the record')
+    return parser
+
+
+def validation_results(num_examples):
+    rng = np.random.RandomState(0)
+    return {'topn': {'top1': rng.rand(num_examples) < .6,
+                     'top5': rng.rand(num_examples) < .8,
+                     'loss': rng.rand(num_examples).astype(np.float32),
+                     'labels': rng.randint(0, 1000, num_examples).astype(np.int32)},
+            'embedding': {'features': rng.rand(num_examples // 50, 128).astype(np.float32),
+                          'loss': np.float32(rng.rand())}}
+
+
+def elementwise(results):
+    """Turn the arrays into lists of numpy scalars, as the old sonify saw them."""
+    return {_vk: {_k: list(_v) if isinstance(_v, np.ndarray) and _v.ndim == 1
+                  else [list(_r) for _r in _v] if isinstance(_v, np.ndarray)
+                  else _v for _k, _v in _vres.items()}
+            for _vk, _vres in results.items()}
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    args = get_parser().parse_args()
+    results = validation_results(args.num_examples)
+    old_style = elementwise(results)
+    record = sonify({'validation_results': results})
+    small = {_vk: {_k: _v for _k, _v in _vres.items()
+                   if not (isinstance(_v, np.ndarray) and
+                           _v.nbytes > args.gfs_array_threshold)}
+             for _vk, _vres in results.items()}
+
+    print('%d examples, best of %d' % (args.num_examples, args.repeats))
+    print('%-34s %10s' % ('', 'seconds'))
+    print('%-34s %10.4f' % ('sonify, element by element',
+          best_time(lambda: sonify({'validation_results': old_style}), args.repeats)))
+    print('%-34s %10.4f' % ('sonify, ndarray.tolist',
+          best_time(lambda: sonify({'validation_results': results}), args.repeats)))
+    print('%-34s %10.4f' % ('BSON encoding',
+          best_time(lambda: bson.BSON.encode(record), args.repeats)))
+    print('record size: %.1f MB, %.1f MB with gfs_array_threshold=%d' % (
+          len(bson.BSON.encode(record)) / 1024 ** 2,
+          len(bson.BSON.encode(sonify({'validation_results': small}))) / 1024 ** 2,
+          args.gfs_array_threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Measure the per-step overhead of tfutils.train on the MNIST test config.
+
+Trains the model of tfutils/tests/test_base.py and splits the wall time of
+the training loop into the time spent in ``train_loop`` (the training
+sess.run calls) and everything else tfutils does per step: reading the
+global step, validation and save bookkeeping. --steps_per_run sets
+train_params['steps_per_run']. With --eval_global_step the step returned
+by the ``optimizer`` train target is dropped, so the step is read with an
+extra ``Session.run`` per step as before. --trivial_model trains a single
+linear layer instead, so that the overhead is not hidden by the model.
+
+    cd tfutils/tests && python ../../benchmarks/step_overhead_benchmark.py --synthetic
+
+"""
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import copy
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tfutils', 'tests'))
+from tfutils import base
+from tfutils.defaults import train_loop
+from test_base import TRAIN_PARAMS, VALIDATION_PARAMS, LEARNING_RATE_PARAMS, \
+        MODEL_BUILD_FUNC
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the per-step overhead of tfutils.train')
+    parser.add_argument(
+            '--num_steps', default=500, type=int, action='store',
+            help='Number of training steps')
+    parser.add_argument(
+            '--synthetic', action='store_true',
+            help='Train on random data instead of downloading MNIST')
+    parser.add_argument(
+            '--trivial_model', action='store_true',
+            help='Train a single linear layer to isolate the Python overhead')
+    parser.add_argument(
+            '--eval_global_step', action='store_true',
+            help='Read the global step with a separate run, as before')
+    parser.add_argument(
+            '--steps_per_run', default=1, type=int, action='store',
+            help='Training steps per call of train_loop')
+    parser.add_argument(
+            '--save_valid_freq', default=20, type=int, action='store',
+            help='Validation frequency, raise it to leave validation out')
+    parser.add_argument(
+            '--save_metrics_freq', default=100, type=int, action='store',
+            help='Metrics saving frequency')
+    parser.add_argument(
+            '--backend', default='local', type=str, action='store',
+            help='Storage backend, local needs no Mongo server')
+    parser.add_argument(
+            '--host', default='localhost', type=str, action='store')
+    parser.add_argument(
+            '--port', default=29101, type=int, action='store')
+    return parser
+
+
+def synthetic_data(batch_size, group, **kwargs):
+    rng = np.random.RandomState(0 if group == 'train' else 1)
+    images = rng.rand(10000, 784).astype(np.float32)
+    labels = rng.randint(0, 10, 10000).astype(np.int32)
+    dataset = tf.data.Dataset.from_tensor_slices(
+            {'images': images, 'labels': labels}).repeat()
+    dataset = dataset.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+    return dataset.make_one_shot_iterator().get_next()
+
+
+def trivial_model(inputs, train=True, **kwargs):
+    weights = tf.get_variable('weights', [784, 10], initializer=tf.zeros_initializer())
+    return tf.matmul(inputs['images'], weights), {}
+
+
+def timed_train_loop(stats, eval_global_step):
+    """Return the default train_loop, timing itself and the loop around it."""
+
+    def timed_loop(sess, train_targets, **kwargs):
+        if stats['start'] is None:
+            stats['start'] = time.time()
+        start = time.time()
+        results = train_loop(sess, train_targets, **kwargs)
+        if eval_global_step:
+            for result in results:
+                result['optimizer'] = None
+        stats['loop_time'] += time.time() - start
+        stats['num_calls'] += 1
+        stats['end'] = time.time()
+        return results
+
+    return timed_loop
+
+
+def main():
+    args = get_parser().parse_args()
+    stats = {'start': None, 'end': None, 'loop_time': 0, 'num_calls': 0}
+    local_root = tempfile.mkdtemp()
+
+    params = {}
+    params['model_params'] = {
+            'func': trivial_model if args.trivial_model else MODEL_BUILD_FUNC}
+    params['save_params'] = {'backend': args.backend,
+                             'local_root': local_root,
+                             'host': args.host,
+                             'port': args.port,
+                             'dbname': 'tfutils_benchmark',
+                             'collname': 'step_overhead',
+                             'exp_id': 'step_overhead_%d' % os.getpid(),
+                             'save_valid_freq': args.save_valid_freq,
+                             'save_metrics_freq': args.save_metrics_freq,
+                             'save_filters_freq': 200,
+                             'cache_filters_freq': 100}
+    params['train_params'] = copy.deepcopy(TRAIN_PARAMS)
+    params['train_params']['num_steps'] = args.num_steps
+    params['train_params']['steps_per_run'] = args.steps_per_run
+    params['train_params']['train_loop'] = {
+            'func': timed_train_loop(stats, args.eval_global_step)}
+    params['learning_rate_params'] = copy.deepcopy(LEARNING_RATE_PARAMS)
+    params['validation_params'] = copy.deepcopy(VALIDATION_PARAMS)
+    params['skip_check'] = True
+    if args.synthetic:
+        params['train_params']['data_params']['func'] = synthetic_data
+        params['validation_params']['valid0']['data_params']['func'] = synthetic_data
+
+    try:
+        base.train_from_params(**params)
+    finally:
+        shutil.rmtree(local_root)
+
+    total = stats['end'] - stats['start']
+    steps = args.num_steps
+    print('%d steps in %d runs, %s model, %s' % (
+          steps, stats['num_calls'], 'trivial' if args.trivial_model else 'MNIST',
+          'global step read with an extra run'
+          if args.eval_global_step else 'global step fetched'))
+    print('train_loop: %.3f ms/step' % (1000 * stats['loop_time'] / steps))
+    print('overhead:   %.3f ms/step' % (1000 * (total - stats['loop_time']) / steps))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,23 @@
-# import os
-# from tfutils import base
-# from tfutils import data
-# from tfutils import error
-# from tfutils import model
-# from tfutils import utils
-# from tfutils import optimizer
+"""
+Entrance of tfutils
 
-# from tfutils.base import (test,
-#                           train,
-#                           predict,
-#                           test_from_params,
-#                           train_from_params)
+The submodules and the main functions below are imported when they are
+first accessed, so ``import tfutils`` does not load TensorFlow, pymongo or
+git. Check `tfutils.train` for function `train_from_params`, and
+`tfutils.test` for function `test_from_params`.
+"""
+from tfutils.version import __version__
+from tfutils.lazy import make_lazy
 
-# __all__ = [
-#     base,
-#     data,
-#     error,
-#     model,
-#     optimizer,
-#     utils,
-#     test,
-#     train,
-#     predict,
-#     test_from_params,
-#     train_from_params,
-# ]
+_SUBMODULES = ['backends', 'base', 'compression', 'data', 'db_interface',
+               'defaults', 'error', 'helper', 'imagenet_data', 'model',
+               'model_tool', 'model_tool_old', 'optimizer', 'test', 'train',
+               'utils', 'validation']
 
-# # put __version__ in the namespace
-# here = os.path.abspath(os.path.dirname(__file__))
-# exec(open(os.path.join(here, 'version.py')).read())
-
-# del os
-# del here
+_lazy_attributes = {_name: ('tfutils.' + _name, None) for _name in _SUBMODULES}
+_lazy_attributes.update({
+    'train_from_params': ('tfutils.base', 'train_from_params'),
+    'test_from_params': ('tfutils.base', 'test_from_params'),
+    'get_params': ('tfutils.base', 'get_params'),
+})
+make_lazy(__name__, _lazy_attributes)
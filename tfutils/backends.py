@@ -0,0 +1,509 @@
+"""Storage backends used by DBInterface.
+
+A backend stores everything DBInterface saves at one location
+(``dbname``/``collname``/``exp_id``):
+
+- records: dicts such as training metrics and validation results.
+- files: blobs along with a metadata record, such as checkpoints (records
+  with ``saved_filters`` set) and ``save_to_gfs`` items. Checkpoints are
+  either permanent or recent; recent ones are kept apart and pruned.
+- params: content addressed params documents (see ``dedup_params``).
+
+MongoBackend keeps everything in MongoDB and GridFS. LocalBackend keeps the
+metadata in SQLite and the blobs in a content-addressed directory, so that
+single-node jobs and benchmarks can run without a Mongo server.
+
+"""
+import os
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import datetime
+import tempfile
+import threading
+import atexit
+import cPickle
+from contextlib import contextmanager
+
+import pymongo
+from pymongo import errors as er
+import gridfs
+from bson.objectid import ObjectId
+
+from tfutils.helper import log
+
+# Maximal number of connections of each shared MongoClient.
+MONGO_MAX_POOL_SIZE = int(os.environ.get('TFUTILS_MONGO_POOL_SIZE', 100))
+
+# MongoClients shared by all DBInterfaces of the process, keyed by (host, port)
+_MONGO_CLIENTS = {}
+_MONGO_CLIENTS_LOCK = threading.Lock()
+
+
+def get_mongo_client(host, port, max_pool_size=None):
+    """Return the process-wide MongoClient connected to ``host:port``.
+
+    The client (and its connection pool) is created and checked with
+    ``server_info()`` on first use only, then shared by every caller.
+
+    Args:
+        host (str): Mongo host.
+        port (int): Mongo port.
+        max_pool_size (int, optional): Size of the connection pool of a newly
+            created client. Defaults to ``MONGO_MAX_POOL_SIZE``, which can be
+            set through the ``TFUTILS_MONGO_POOL_SIZE`` environment variable.
+
+    Returns:
+        pymongo.MongoClient: The shared client.
+
+    """
+    key = (host, port)
+    with _MONGO_CLIENTS_LOCK:
+        if key not in _MONGO_CLIENTS:
+            if max_pool_size is None:
+                max_pool_size = MONGO_MAX_POOL_SIZE
+            conn = pymongo.MongoClient(host=host, port=port,
+                                       maxPoolSize=max_pool_size)
+            conn.server_info()
+            _MONGO_CLIENTS[key] = conn
+        return _MONGO_CLIENTS[key]
+
+
+@atexit.register
+def close_mongo_clients():
+    """Close all shared MongoClients."""
+    with _MONGO_CLIENTS_LOCK:
+        for conn in _MONGO_CLIENTS.values():
+            conn.close()
+        _MONGO_CLIENTS.clear()
+
+
+def recent_name(dbname, collname, exp_id):
+    """Return the name of the store of recent checkpoints of an experiment."""
+    return '_'.join([dbname, collname, exp_id, '__RECENT'])
+
+
+class StorageBackend(object):
+    """Interface of the storage used by DBInterface.
+
+    Methods taking a ``recent`` flag act on the recent checkpoints when it
+    is set and on the permanent store otherwise.
+
+    """
+
+    def new_file(self, recent=False, **kwargs):
+        """Return a writable file that is stored once closed.
+
+        Keyword arguments become fields of the file record. The returned
+        object has ``write``, ``close`` and ``abort`` methods and its ``_id``
+        is the id of the record.
+
+        """
+        raise NotImplementedError
+
+    def put(self, data, recent=False, **kwargs):
+        """Store ``data`` (a string or readable file) and return its id."""
+        raise NotImplementedError
+
+    def open_download_stream(self, record, recent=False):
+        """Return a readable stream of the file of ``record``."""
+        raise NotImplementedError
+
+    def download_to_stream(self, record, destination, recent=False):
+        """Write the file of ``record`` into ``destination``."""
+        source = self.open_download_stream(record, recent=recent)
+        try:
+            shutil.copyfileobj(source, destination)
+        finally:
+            source.close()
+
+    def insert_records(self, records):
+        """Insert ``records`` in order and return their ids."""
+        raise NotImplementedError
+
+    def find(self, query, recent=False):
+        """Iterate over the records (files included) matching ``query``."""
+        raise NotImplementedError
+
+    def find_latest_checkpoint(self, query, recent=False):
+        """Return the latest uploaded file record matching ``query``, or None."""
+        raise NotImplementedError
+
+    def prune_recent(self, max_num):
+        """Delete the oldest recent checkpoints, keeping ``max_num``."""
+        raise NotImplementedError
+
+    def put_params(self, params_id, doc):
+        """Store the params document ``doc`` unless ``params_id`` exists."""
+        raise NotImplementedError
+
+    def get_params(self, params_id):
+        """Return the params document ``params_id``, or None."""
+        raise NotImplementedError
+
+    def ensure_indexes(self):
+        """Create the indexes used by the queries above, if needed."""
+        pass
+
+    def full_name(self, recent=False):
+        """Return a readable name of the store, for logging."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the backend."""
+        pass
+
+
+class MongoBackend(StorageBackend):
+    """Store records and checkpoints in MongoDB and GridFS.
+
+    Records and files live in the GridFS ``collfs`` (in ``<collname>.files``),
+    recent checkpoints in ``collfs_recent`` and params in
+    ``<collname>.params``.
+
+    Args:
+        collfs (gridfs.GridFS): Permanent store.
+        collfs_recent (gridfs.GridFS): Store of recent checkpoints.
+
+    """
+
+    def __init__(self, collfs, collfs_recent):
+        self.collfs = collfs
+        self.collfs_recent = collfs_recent
+
+    @classmethod
+    def from_location(cls, host, port, dbname, collname, exp_id):
+        conn = get_mongo_client(host, port)
+        return cls(gridfs.GridFS(conn[dbname], collname),
+                   gridfs.GridFS(conn[recent_name(dbname, collname, exp_id)]))
+
+    @property
+    def conn(self):
+        return self.collfs._GridFS__collection.database.client
+
+    @property
+    def params_coll(self):
+        return self.collfs._GridFS__collection.params
+
+    def _fs(self, recent):
+        return self.collfs_recent if recent else self.collfs
+
+    def _files(self, recent):
+        return self._fs(recent)._GridFS__files
+
+    def _bucket(self, recent):
+        files = self._files(recent)
+        return gridfs.GridFSBucket(files._Collection__database,
+                                   bucket_name=files.name.split('.')[0])
+
+    def new_file(self, recent=False, **kwargs):
+        return self._fs(recent).new_file(**kwargs)
+
+    def put(self, data, recent=False, **kwargs):
+        return self._fs(recent).put(data, **kwargs)
+
+    def open_download_stream(self, record, recent=False):
+        return self._bucket(recent).open_download_stream(record['_id'])
+
+    def download_to_stream(self, record, destination, recent=False):
+        self._bucket(recent).download_to_stream(record['_id'], destination)
+
+    def insert_records(self, records):
+        if len(records) == 1:
+            return [self.collfs._GridFS__files.insert_one(records[0]).inserted_id]
+        return self.collfs._GridFS__files.insert_many(records, ordered=True).inserted_ids
+
+    def find(self, query, recent=False):
+        return self._files(recent).find(query)
+
+    def find_latest_checkpoint(self, query, recent=False):
+        return self._files(recent).find_one(query, sort=[('uploadDate', -1)])
+
+    def prune_recent(self, max_num):
+        recent_gridfs_files = self._files(True)
+        recent_query_result = recent_gridfs_files.find({'saved_filters': True}, sort=[('uploadDate', 1)])
+        num_cached_filters = recent_query_result.count()
+        if num_cached_filters > max_num:
+            log.info('Cleaning up cached filters')
+            fsbucket = self._bucket(True)
+            for del_indx in xrange(0, num_cached_filters - max_num):
+                fsbucket.delete(recent_query_result[del_indx]['_id'])
+
+    def put_params(self, params_id, doc):
+        self.params_coll.update_one({'_id': params_id},
+                                    {'$setOnInsert': {'params': doc}},
+                                    upsert=True)
+
+    def get_params(self, params_id):
+        doc = self.params_coll.find_one({'_id': params_id})
+        return None if doc is None else doc['params']
+
+    def ensure_indexes(self):
+        """Create the indexes used by checkpoint lookup and retention queries.
+
+        Covers the latest-checkpoint lookup in `DBInterface.load_from_db`, the
+        recent checkpoint cleanup and the `item_for` queries of feature readers.
+        Creating an existing index is a no-op, so this is safe to call on every
+        start. Failures (e.g. read-only users) are logged and ignored.
+
+        """
+        for coll in [self._files(False), self._files(True)]:
+            try:
+                coll.create_index([('exp_id', pymongo.ASCENDING),
+                                   ('saved_filters', pymongo.ASCENDING),
+                                   ('uploadDate', pymongo.DESCENDING)],
+                                  background=True)
+                coll.create_index([('saved_filters', pymongo.ASCENDING),
+                                   ('uploadDate', pymongo.DESCENDING)],
+                                  background=True)
+                coll.create_index('item_for', background=True, sparse=True)
+            except er.PyMongoError as error:
+                log.warning('Could not create indexes on %s: %s' % (coll.full_name, error))
+
+    def full_name(self, recent=False):
+        return self._files(recent).full_name
+
+
+class _LocalFile(object):
+    """Writable blob of a LocalBackend, hashed while it is written."""
+
+    def __init__(self, backend, recent, kwargs):
+        self._backend = backend
+        self._recent = recent
+        self._kwargs = kwargs
+        self._id = kwargs.pop('_id', None) or ObjectId()
+        self._sha1 = hashlib.sha1()
+        self._length = 0
+        fd, self._tmp_path = tempfile.mkstemp(dir=backend.tmp_dir)
+        self._fp = os.fdopen(fd, 'wb')
+        self.closed = False
+
+    def __setattr__(self, name, value):
+        # like GridIn, other attributes become fields of the file record
+        if name.startswith('_') or name == 'closed':
+            object.__setattr__(self, name, value)
+        else:
+            self._kwargs[name] = value
+
+    def write(self, data):
+        self._sha1.update(data)
+        self._length += len(data)
+        self._fp.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._fp.close()
+        blob = self._sha1.hexdigest()
+        blob_path = self._backend.blob_path(blob)
+        doc = dict(self._kwargs)
+        doc.update({'_id': self._id,
+                    'blob': blob,
+                    'length': self._length,
+                    'uploadDate': datetime.datetime.utcnow()})
+        # the blob must not be pruned between the dedup check and the insert
+        with self._backend.blob_lock():
+            if os.path.exists(blob_path):
+                os.remove(self._tmp_path)
+            else:
+                if not os.path.isdir(os.path.dirname(blob_path)):
+                    try:
+                        os.makedirs(os.path.dirname(blob_path))
+                    except OSError:
+                        pass
+                os.rename(self._tmp_path, blob_path)
+            self._backend._insert(doc, recent=self._recent, upload_date=time.time())
+
+    def abort(self):
+        self.closed = True
+        self._fp.close()
+        os.remove(self._tmp_path)
+
+
+class LocalBackend(StorageBackend):
+    """Store records in SQLite and files in a content-addressed directory.
+
+    All experiments of ``dbname`` share ``<root>/<dbname>/metadata.sqlite``
+    and the blobs in ``<root>/<dbname>/blobs``, where a file is stored under
+    the sha1 of its content. Queries only support equality on (dotted) keys.
+
+    Args:
+        root (str): Directory holding the databases.
+        dbname (str): Name of the database.
+        collname (str): Name of the collection.
+        exp_id (str): Experiment id, used to name the recent checkpoints.
+
+    """
+
+    def __init__(self, root, dbname, collname, exp_id):
+        self.path = os.path.join(root, dbname)
+        self.blob_dir = os.path.join(self.path, 'blobs')
+        self.tmp_dir = os.path.join(self.path, 'tmp')
+        for dirn in [self.blob_dir, self.tmp_dir]:
+            if not os.path.isdir(dirn):
+                try:
+                    os.makedirs(dirn)
+                except OSError:
+                    pass
+        self.coll = collname
+        self.coll_recent = recent_name(dbname, collname, exp_id)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.path, 'metadata.sqlite'),
+                                   timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS records ('
+                             'id TEXT PRIMARY KEY, coll TEXT, exp_id TEXT, '
+                             'saved_filters INTEGER, upload_date REAL, '
+                             'blob TEXT, doc BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS records_latest ON records '
+                             '(coll, exp_id, saved_filters, upload_date)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS records_blob ON records (blob)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS params ('
+                             'id TEXT PRIMARY KEY, doc BLOB)')
+
+    def blob_path(self, blob):
+        return os.path.join(self.blob_dir, blob[:2], blob)
+
+    @contextmanager
+    def blob_lock(self):
+        """Hold the lock of the blob directory, shared by all processes.
+
+        Storing a blob and inserting its record, as well as counting the
+        references of a blob and removing it, happen under this lock.
+
+        """
+        with open(os.path.join(self.path, 'blobs.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _coll(self, recent):
+        return self.coll_recent if recent else self.coll
+
+    @staticmethod
+    def _row(doc, coll, upload_date=None):
+        exp_id = doc.get('exp_id')
+        if not isinstance(exp_id, basestring):
+            exp_id = None
+        return (str(doc['_id']), coll, exp_id, int(bool(doc.get('saved_filters'))),
+                upload_date, doc.get('blob'),
+                sqlite3.Binary(cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL)))
+
+    def _insert(self, doc, recent=False, upload_date=None):
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             self._row(doc, self._coll(recent), upload_date))
+
+    def _select(self, query, recent, order):
+        sql = 'SELECT doc FROM records WHERE coll = ?'
+        args = [self._coll(recent)]
+        if isinstance(query.get('_id'), ObjectId):
+            sql += ' AND id = ?'
+            args.append(str(query['_id']))
+        if isinstance(query.get('exp_id'), basestring):
+            sql += ' AND exp_id = ?'
+            args.append(query['exp_id'])
+        if isinstance(query.get('saved_filters'), (bool, int)):
+            sql += ' AND saved_filters = ?'
+            args.append(int(query['saved_filters']))
+        with self._lock:
+            rows = self._db.execute(sql + ' ORDER BY ' + order, args).fetchall()
+        for row in rows:
+            doc = cPickle.loads(str(row[0]))
+            if matches(doc, query):
+                yield doc
+
+    def new_file(self, recent=False, **kwargs):
+        return _LocalFile(self, recent, kwargs)
+
+    def put(self, data, recent=False, **kwargs):
+        grid_file = self.new_file(recent=recent, **kwargs)
+        try:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, grid_file)
+            else:
+                grid_file.write(data)
+        except Exception:
+            grid_file.abort()
+            raise
+        grid_file.close()
+        return grid_file._id
+
+    def open_download_stream(self, record, recent=False):
+        return open(self.blob_path(record['blob']), 'rb')
+
+    def insert_records(self, records):
+        for rec in records:
+            if '_id' not in rec:
+                rec['_id'] = ObjectId()
+        rows = [self._row(rec, self.coll) for rec in records]
+        with self._lock, self._db:
+            self._db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return [rec['_id'] for rec in records]
+
+    def find(self, query, recent=False):
+        return self._select(query, recent, 'rowid')
+
+    def find_latest_checkpoint(self, query, recent=False):
+        for doc in self._select(query, recent, 'upload_date DESC, rowid DESC'):
+            if 'blob' in doc:
+                return doc
+
+    def prune_recent(self, max_num):
+        with self.blob_lock(), self._lock, self._db:
+            rows = self._db.execute('SELECT id, blob FROM records WHERE coll = ? '
+                                    'AND saved_filters = 1 ORDER BY upload_date, rowid',
+                                    [self.coll_recent]).fetchall()
+            if len(rows) <= max_num:
+                return
+            log.info('Cleaning up cached filters')
+            for _id, blob in rows[:len(rows) - max_num]:
+                self._db.execute('DELETE FROM records WHERE id = ?', [_id])
+                if self._db.execute('SELECT COUNT(*) FROM records WHERE blob = ?',
+                                    [blob]).fetchone()[0] == 0:
+                    os.remove(self.blob_path(blob))
+
+    def put_params(self, params_id, doc):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR IGNORE INTO params VALUES (?, ?)',
+                             (params_id, sqlite3.Binary(cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL))))
+
+    def get_params(self, params_id):
+        with self._lock:
+            row = self._db.execute('SELECT doc FROM params WHERE id = ?',
+                                   [params_id]).fetchone()
+        return None if row is None else cPickle.loads(str(row[0]))
+
+    def full_name(self, recent=False):
+        return '%s:%s' % (self.path, self._coll(recent))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def matches(doc, query):
+    """Return whether ``doc`` has all the (dotted) key values of ``query``.
+
+    Only equality is supported; Mongo query operators raise a ValueError.
+
+    """
+    for key, value in query.items():
+        if key.startswith('$') or (isinstance(value, dict) and
+                                   any(k.startswith('$') for k in value)):
+            raise ValueError('Unsupported query %s, only equality is supported '
+                             'by the local backend.' % repr(query))
+        field = doc
+        for part in key.split('.'):
+            if not isinstance(field, dict) or part not in field:
+                return False
+            field = field[part]
+        if field != value:
+            return False
+    return True
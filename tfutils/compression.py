@@ -0,0 +1,191 @@
+"""Compression codecs for checkpoint tarballs and save_to_gfs payloads.
+
+zlib and bz2 are always available; lzma (python 3 or backports.lzma), lz4
+(lz4.frame) and zstd (zstandard) are used when installed.  Data is
+compressed and decompressed incrementally, so blobs can be streamed to and
+from the database without being held in memory.
+
+"""
+import zlib
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _LZ4Compressor(object):
+
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(
+                compression_level=level or 0)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, ''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, ''
+        return header + self._compressor.flush()
+
+
+def _zstd_compressor(level):
+    return zstandard.ZstdCompressor(level=level or 3).compressobj()
+
+
+def _zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# name: (module needed, compressor(level), decompressor())
+_CODECS = {
+    'zlib': (zlib,
+             lambda level: zlib.compressobj(6 if level is None else level),
+             zlib.decompressobj),
+    'bz2': (bz2,
+            lambda level: bz2.BZ2Compressor(9 if level is None else level),
+            bz2.BZ2Decompressor),
+    'lzma': (lzma,
+             lambda level: lzma.LZMACompressor(preset=level),
+             lambda: lzma.LZMADecompressor()),
+    'lz4': (lz4_frame,
+            _LZ4Compressor,
+            lambda: lz4_frame.LZ4FrameDecompressor()),
+    'zstd': (zstandard,
+             _zstd_compressor,
+             _zstd_decompressor),
+}
+
+
+def available_codecs():
+    """Return the names of the codecs usable in this environment."""
+    return sorted(name for name, codec in _CODECS.items() if codec[0] is not None)
+
+
+def _get_codec(name):
+    if name not in _CODECS:
+        raise ValueError('Unknown compression codec %s, choose from %s.' %
+                         (name, sorted(_CODECS)))
+    if _CODECS[name][0] is None:
+        raise ImportError('The module needed by compression codec %s is not installed.' % name)
+    return _CODECS[name]
+
+
+def get_compressor(name, level=None):
+    """Return a compressor object (with ``compress`` and ``flush``) of codec ``name``."""
+    return _get_codec(name)[1](level)
+
+
+def get_decompressor(name):
+    """Return a decompressor object (with ``decompress``) of codec ``name``."""
+    return _get_codec(name)[2]()
+
+
+class CompressingWriter(object):
+    """Write-only file compressing its data into ``fileobj``.
+
+    ``close`` flushes the compressor but leaves ``fileobj`` open.
+
+    Args:
+        fileobj (file-like): Destination of the compressed data.
+        codec (str): Name of the compression codec.
+        level (int, optional): Compression level, codec default if None.
+
+    """
+
+    def __init__(self, fileobj, codec, level=None):
+        self.fileobj = fileobj
+        self.compression = codec
+        self.raw_size = 0
+        self.compressed_size = 0
+        self._compressor = get_compressor(codec, level)
+        self.closed = False
+
+    def _write(self, data):
+        if data:
+            self.compressed_size += len(data)
+            self.fileobj.write(data)
+
+    def write(self, data):
+        self.raw_size += len(data)
+        self._write(self._compressor.compress(data))
+
+    def close(self):
+        if not self.closed:
+            self._write(self._compressor.flush())
+            self.closed = True
+
+
+class DecompressingReader(object):
+    """Read-only file decompressing the data read from ``fileobj``.
+
+    Args:
+        fileobj (file-like): Source of the compressed data.
+        codec (str): Name of the compression codec.
+
+    """
+
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self._decompressor = get_decompressor(codec)
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+
+    def _fill(self):
+        """Decompress the next chunk into the buffer; return False at the end."""
+        while not self._eof:
+            data = self.fileobj.read(CHUNK_SIZE)
+            if data:
+                data = self._decompressor.decompress(data)
+            else:
+                self._eof = True
+                if hasattr(self._decompressor, 'flush'):
+                    data = self._decompressor.flush()
+            if data:
+                self._buffer, self._offset = data, 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._offset >= len(self._buffer) and not self._fill():
+                break
+            end = len(self._buffer) if size < 0 else min(len(self._buffer), self._offset + size)
+            chunks.append(self._buffer[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return ''.join(chunks)
+
+    def close(self):
+        self.fileobj.close()
+
+
+def compress(data, codec, level=None):
+    """Return ``data`` compressed with ``codec``."""
+    compressor = get_compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, codec):
+    """Return ``data`` decompressed with ``codec``."""
+    return get_decompressor(codec).decompress(data)
@@ -1,9 +1,9 @@
-import pymongo
 from pymongo import errors as er
-import gridfs
 import tarfile
 import cPickle
+import cStringIO
 from bson.objectid import ObjectId
+from bson.binary import Binary
 import datetime
 from tensorflow.python import DType
 import numpy as np
@@ -14,14 +14,25 @@ import tensorflow as tf
 import copy
 import time
 from tensorflow.core.protobuf import saver_pb2
+from tensorflow.python.ops import io_ops
+from tensorflow.python.ops import variables
+from tensorflow.python.training import saver as saver_lib
 import re
 import sys
 import threading
-import git
+import Queue
+import shutil
+import hashlib
+import json
+import fcntl
+import tempfile
 
 from tfutils.utils import strip_prefix_from_name, \
         strip_prefix
 from tfutils.helper import log
+from tfutils.backends import MongoBackend, LocalBackend
+from tfutils.compression import (CompressingWriter, DecompressingReader, CHUNK_SIZE,
+                                 get_compressor)
 from tfutils.defaults import DEFAULT_SAVE_PARAMS, DEFAULT_LOAD_PARAMS
 
 if 'TFUTILS_HOME' in os.environ:
@@ -29,6 +40,20 @@ if 'TFUTILS_HOME' in os.environ:
 else:
     TFUTILS_HOME = os.path.join(os.environ['HOME'], '.tfutils')
 
+# params documents loaded from the database, keyed by their content hash
+_PARAMS_CACHE = {}
+
+# Directory of the databases of the local backend
+LOCAL_BACKEND_ROOT = os.path.join(TFUTILS_HOME, 'local')
+
+# Directory of the checkpoint cache shared by all jobs of a node
+CHECKPOINT_CACHE_ROOT = os.path.join(TFUTILS_HOME, 'checkpoint_cache')
+
+# git_info by git dir and version_check_and_info by module name, kept for
+# the lifetime of the process
+_GIT_INFO_CACHE = {}
+_MODULE_INFO_CACHE = {}
+
 
 def version_info(module):
     """Get version of a standard python module.
@@ -45,6 +70,7 @@ def version_info(module):
     elif hasattr(module, 'VERSION'):
         version = module.VERSION
     else:
+        import pkg_resources  # slow to import, only needed here
         pkgname = module.__name__.split('.')[0]
         try:
             info = pkg_resources.get_distribution(pkgname)
@@ -68,6 +94,8 @@ def git_info(repo):
         dict: Git repo information
 
     """
+    if repo.git_dir in _GIT_INFO_CACHE:
+        return copy.deepcopy(_GIT_INFO_CACHE[repo.git_dir])
     if repo.is_dirty():
         log.warning('repo %s is dirty -- having committment issues?' %
                     repo.git_dir)
@@ -103,6 +131,7 @@ def git_info(repo):
             'clean': clean,
             'active_branch_in_origin': active_branch_in_origin,
             'commit_in_log': commit_in_log}
+    _GIT_INFO_CACHE[repo.git_dir] = copy.deepcopy(info)
     return info
 
 
@@ -113,6 +142,82 @@ def verify_pb2_v2_files(cache_prefix, ckpt_record):
     assert ndf == sndf, (ndf, sndf)
 
 
+def has_pb2_v2_files(cache_prefix, ckpt_record):
+    """Return whether a complete V2 checkpoint for ``ckpt_record`` is on disk."""
+    try:
+        verify_pb2_v2_files(cache_prefix, ckpt_record)
+    except (AssertionError, OSError, TypeError):
+        return False
+    return True
+
+
+def array_digest(value):
+    """Return a digest of the dtype, shape and bytes of an array."""
+    value = np.ascontiguousarray(value)
+    digest = hashlib.sha1(str((value.dtype.str, value.shape)))
+    digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+def read_checkpoint(save_path):
+    """Return all variables of a checkpoint as a dict of numpy arrays."""
+    reader = tf.train.NewCheckpointReader(save_path)
+    return {name: reader.get_tensor(name)
+            for name in reader.get_variable_to_shape_map()}
+
+
+def checkpoint_digests(save_path):
+    """Return the ``array_digest`` of each variable of a checkpoint."""
+    reader = tf.train.NewCheckpointReader(save_path)
+    return {name: array_digest(reader.get_tensor(name))
+            for name in reader.get_variable_to_shape_map()}
+
+
+def write_checkpoint(arrays, save_path):
+    """Write a V2 checkpoint of the numpy ``arrays``, keyed by variable name.
+
+    Returns:
+        str: Path prefix of the checkpoint.
+
+    """
+    specs = {name: (tf.as_dtype(np.asarray(value).dtype), np.shape(value))
+             for name, value in arrays.items()}
+    writer = ArrayCheckpointWriter(specs)
+    try:
+        return writer.save(arrays, save_path)
+    finally:
+        writer.close()
+
+
+# Variable stored in every delta checkpoint, so none is empty
+DELTA_MARKER = '__tfutils_delta__'
+
+
+def write_delta_checkpoint(save_path, base_digests, delta_path):
+    """Write the variables of ``save_path`` whose digest is not in ``base_digests``.
+
+    Returns:
+        tuple: Path prefix of the delta checkpoint and names of the changed
+        variables.
+
+    """
+    reader = tf.train.NewCheckpointReader(save_path)
+    arrays = {DELTA_MARKER: np.zeros((), dtype=np.int32)}
+    for name in reader.get_variable_to_shape_map():
+        value = reader.get_tensor(name)
+        if base_digests.get(name) != array_digest(value):
+            arrays[name] = value
+    return write_checkpoint(arrays, delta_path), sorted(set(arrays) - {DELTA_MARKER})
+
+
+def merge_delta_checkpoint(base_path, delta_path, save_path):
+    """Write the checkpoint of ``base_path`` updated with the delta of ``delta_path``."""
+    arrays = read_checkpoint(base_path)
+    arrays.update(read_checkpoint(delta_path))
+    arrays.pop(DELTA_MARKER, None)
+    return write_checkpoint(arrays, save_path)
+
+
 def get_saver_pb2_v2_files(prefix):
     dirn, pref = os.path.split(prefix)
     pref = pref + '.'
@@ -141,6 +246,441 @@ def get_saver_pb2_v2_files(prefix):
     return file_data
 
 
+def _new_file(fs, compression=None, compression_level=None, **kwargs):
+    """Open a new file of ``fs`` and the (compressing) writer to write it with."""
+    grid_file = fs.new_file(**kwargs)
+    if compression is None:
+        return grid_file, grid_file
+    return grid_file, CompressingWriter(grid_file, compression, compression_level)
+
+
+def _close_file(grid_file, writer):
+    if writer is not grid_file:
+        writer.close()
+        # fields of the file record, set before it is closed
+        grid_file.compression = writer.compression
+        grid_file.raw_length = writer.raw_size
+    grid_file.close()
+    return grid_file._id
+
+
+def put_tar_stream(fs, files, compression=None, compression_level=None, **kwargs):
+    """Stream a tar archive of ``files`` straight into GridFS.
+
+    The archive is written with ``tarfile`` in stream mode into a ``GridIn``,
+    so no intermediate ``.tar`` is created on local disk.  Keyword arguments
+    become fields of the GridFS file document, exactly as with ``GridFS.put``.
+
+    Args:
+        fs (gridfs.GridFS or StorageBackend): Store to put the archive into.
+        files (list): Paths of the files to archive.
+        compression (str, optional): Codec to compress the archive with (see
+            `tfutils.compression`). The codec and the uncompressed size are
+            recorded in the ``compression`` and ``raw_length`` fields.
+        compression_level (int, optional): Level of the codec.
+
+    Returns:
+        ObjectId: ``_id`` of the new GridFS file.
+
+    """
+    grid_file, writer = _new_file(fs, compression, compression_level, **kwargs)
+    try:
+        tar = tarfile.open(fileobj=writer, mode='w|')
+        for _f in files:
+            tar.add(_f, arcname=os.path.split(_f)[1])
+        tar.close()
+    except Exception:
+        grid_file.abort()
+        raise
+    return _close_file(grid_file, writer)
+
+
+def put_file(fs, data, compression=None, compression_level=None, **kwargs):
+    """Put ``data`` (a string or readable file) into ``fs``, optionally compressed.
+
+    Works like `put_tar_stream`, for a single blob.
+
+    Returns:
+        ObjectId: ``_id`` of the new file.
+
+    """
+    if compression is None:
+        return fs.put(data, **kwargs)
+    if isinstance(data, basestring):
+        data = cStringIO.StringIO(data)
+    grid_file, writer = _new_file(fs, compression, compression_level, **kwargs)
+    try:
+        shutil.copyfileobj(data, writer, CHUNK_SIZE)
+    except Exception:
+        grid_file.abort()
+        raise
+    return _close_file(grid_file, writer)
+
+
+def open_file(backend, record, recent=False):
+    """Return a readable stream of the (decompressed) file of ``record``."""
+    stream = backend.open_download_stream(record, recent=recent)
+    if record.get('compression'):
+        stream = DecompressingReader(stream, record['compression'])
+    return stream
+
+
+GFS_FORMATS = ('pickle', 'npy')
+TRAIN_RESULTS_FORMATS = ('list', 'columnar')
+
+
+def put_array(fs, array, compression=None, compression_level=None, **kwargs):
+    """Put ``array`` into ``fs`` as a ``.npy`` file, without pickling it.
+
+    The array data is written in chunks straight from its buffer. Besides
+    ``kwargs``, the file record gets ``dtype``, ``shape`` and ``data_offset``
+    (the length of the ``.npy`` header) fields, so readers can locate the
+    data without parsing the header.
+
+    Returns:
+        ObjectId: ``_id`` of the new file.
+
+    """
+    array = np.ascontiguousarray(array)
+    header = cStringIO.StringIO()
+    np.lib.format.write_array_header_1_0(
+            header, np.lib.format.header_data_from_array_1_0(array))
+    header = header.getvalue()
+    grid_file, writer = _new_file(fs, compression, compression_level,
+                                  dtype=array.dtype.str, shape=list(array.shape),
+                                  data_offset=len(header), **kwargs)
+    try:
+        writer.write(header)
+        data = array.reshape(-1).view(np.uint8)
+        for start in xrange(0, len(data), CHUNK_SIZE):
+            writer.write(data[start:start + CHUNK_SIZE].tostring())
+    except Exception:
+        grid_file.abort()
+        raise
+    return _close_file(grid_file, writer)
+
+
+def _gfs_leaves(tree, prefix=()):
+    """Yield the (key path, value) leaves of a nested save_to_gfs dict."""
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            for leaf in _gfs_leaves(value, prefix + (key,)):
+                yield leaf
+        else:
+            yield prefix + (key,), value
+
+
+def put_gfs_items(fs, save_to_gfs, filename, item_for,
+                  compression=None, compression_level=None):
+    """Store every value of the nested ``save_to_gfs`` dict in its own file.
+
+    Values are stored with `put_array` (``item_format`` 'npy'), or pickled
+    (``item_format`` 'pickle') when they are not numeric arrays, e.g. ragged
+    lists. Each file has ``item_for`` and an ``item_key`` field holding the
+    dotted path of the value, e.g. ``validation_results.valid1.features``.
+
+    """
+    for path, value in _gfs_leaves(save_to_gfs):
+        key = '.'.join(path)
+        kwargs = {'filename': '%s/%s' % (filename, key),
+                  'item_for': item_for,
+                  'item_key': key}
+        array = np.asarray(value)
+        if array.dtype.hasobject:
+            put_file(fs, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL),
+                     compression=compression, compression_level=compression_level,
+                     item_format='pickle', **kwargs)
+        else:
+            put_array(fs, array, compression=compression,
+                      compression_level=compression_level,
+                      item_format='npy', **kwargs)
+
+
+def _read_array_data(backend, item, out):
+    """Stream the data of the npy file ``item`` into the contiguous array ``out``."""
+    assert out.flags.c_contiguous, 'Can only read into a contiguous array.'
+    data = out.reshape(-1).view(np.uint8)
+    stream = open_file(backend, item)
+    try:
+        stream.read(item['data_offset'])
+        pos = 0
+        while pos < len(data):
+            chunk = stream.read(min(CHUNK_SIZE, len(data) - pos))
+            if not chunk:
+                raise IOError('File %s is truncated.' % item['_id'])
+            data[pos:pos + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+            pos += len(chunk)
+    finally:
+        stream.close()
+
+
+def find_gfs_items(backend, record_id):
+    """Return the save_to_gfs files of the record ``record_id``, by ``item_key``.
+
+    Files saved in the 'pickle' format have no ``item_key`` and are returned
+    under None.
+
+    """
+    return {item.get('item_key'): item
+            for item in backend.find({'item_for': record_id})}
+
+
+def load_gfs_item(backend, item, mmap_dir=None):
+    """Load the value stored in the save_to_gfs file ``item``.
+
+    Pickled files are unpickled (for the 'pickle' format, the whole dict of
+    the record). npy files are streamed straight into an array of their
+    dtype and shape; with ``mmap_dir``, they are instead downloaded
+    (decompressed) once to ``<mmap_dir>/<_id>.npy`` and memory-mapped.
+
+    """
+    if item.get('item_format') != 'npy':
+        stream = open_file(backend, item)
+        try:
+            return cPickle.loads(stream.read())
+        finally:
+            stream.close()
+    if mmap_dir is not None:
+        path = os.path.join(mmap_dir, '%s.npy' % item['_id'])
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=mmap_dir)
+            stream = open_file(backend, item)
+            try:
+                with os.fdopen(fd, 'wb') as dest:
+                    shutil.copyfileobj(stream, dest, CHUNK_SIZE)
+            finally:
+                stream.close()
+            os.rename(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+    out = np.empty(item['shape'], dtype=np.dtype(str(item['dtype'])))
+    _read_array_data(backend, item, out)
+    return out
+
+
+def load_gfs_features(backend, record, key, target=None, out=None):
+    """Concatenate the ``key`` arrays saved by all intermediate steps of a validation.
+
+    The intermediate steps must have been saved with the 'npy'
+    save_to_gfs_format. Each batch is streamed into its slice of the result,
+    so the batches are never held in memory twice.
+
+    Args:
+        backend (StorageBackend): Store holding the records.
+        record (dict): Final record of the validation run, whose
+            ``validation_results.<target>.intermediate_steps`` lists the
+            records of the intermediate steps.
+        key (str): save_to_gfs key to load, e.g. 'features'.
+        target (str, optional): Validation target, may be omitted if the
+            record has only one.
+        out (np.ndarray, optional): Contiguous array to fill (e.g. from
+            ``np.lib.format.open_memmap`` for features larger than memory).
+
+    Returns:
+        np.ndarray: The batches, concatenated along the first axis in step order.
+
+    """
+    results = record['validation_results']
+    if target is None:
+        if len(results) != 1:
+            raise ValueError('Record has several validation targets %s, choose one.'
+                             % sorted(results))
+        target = list(results)[0]
+    item_key = 'validation_results.%s.%s' % (target, key)
+    items = []
+    for step_id in results[target]['intermediate_steps']:
+        found = list(backend.find({'item_for': step_id, 'item_key': item_key}))
+        if not found:
+            raise KeyError('No %s file saved for record %s.' % (item_key, step_id))
+        items.append(found[0])
+    if not items:
+        raise ValueError('Validation %s has no intermediate steps.' % target)
+
+    shapes = [tuple(item['shape']) for item in items]
+    dtype = np.dtype(str(items[0]['dtype']))
+    shape = (sum(_s[0] for _s in shapes),) + shapes[0][1:]
+    if any(_s[1:] != shape[1:] for _s in shapes):
+        raise ValueError('Batches of %s have different shapes %s.' % (item_key, shapes))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError('out must have shape %s and dtype %s.' % (shape, dtype))
+    start = 0
+    for item, item_shape in zip(items, shapes):
+        _read_array_data(backend, item, out[start:start + item_shape[0]])
+        start += item_shape[0]
+    return out
+
+
+def _encode_array(array):
+    """Return a compact record field holding the 1-D numeric ``array``."""
+    return {'dtype': array.dtype.str, 'data': Binary(array.tostring())}
+
+
+def _decode_array(field):
+    return np.frombuffer(field['data'], dtype=np.dtype(str(field['dtype'])))
+
+
+class TrainResultsBuffer(object):
+    """Columnar accumulator of the ``train_results`` of the steps between two saves.
+
+    Numeric scalar results are kept in one preallocated array per key, grown
+    by doubling, instead of one dict per step. Other results (e.g. arrays
+    for save_to_gfs) are kept in lists along with their row. `to_record`
+    encodes the columns as binary arrays, with summary statistics, and
+    `load_train_results` rebuilds the list of per-step dicts.
+
+    """
+
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.num_rows = 0
+        self.steps = np.empty(self.capacity, dtype=np.int64)
+        # key: (values, present)
+        self.columns = {}
+        # key: [(row, value)]
+        self.objects = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def _grow(self):
+        size = 2 * len(self.steps)
+        self.steps = np.resize(self.steps, size)
+        for key, (values, present) in self.columns.items():
+            grown_present = np.zeros(size, dtype=bool)
+            grown_present[:len(present)] = present
+            self.columns[key] = (np.resize(values, size), grown_present)
+
+    def append(self, step, train_res):
+        if self.num_rows == len(self.steps):
+            self._grow()
+        row = self.num_rows
+        self.steps[row] = step
+        for key, value in train_res.items():
+            if isinstance(value, (int, long, float, np.number)) and key not in self.objects:
+                if key not in self.columns:
+                    self.columns[key] = (np.zeros(len(self.steps), dtype=np.asarray(value).dtype),
+                                         np.zeros(len(self.steps), dtype=bool))
+                values, present = self.columns[key]
+                dtype = np.result_type(values.dtype, type(value))
+                if dtype != values.dtype:
+                    # e.g. a float after ints
+                    values = values.astype(dtype)
+                    self.columns[key] = (values, present)
+                values[row] = value
+                present[row] = True
+            else:
+                self.objects.setdefault(key, []).append((row, value))
+        self.num_rows += 1
+
+    def pop(self, key):
+        """Remove ``key`` from the buffer and return its values, in step order."""
+        if key in self.columns:
+            values, present = self.columns.pop(key)
+            return list(values[:self.num_rows][present[:self.num_rows]])
+        return [value for _, value in self.objects.pop(key, [])]
+
+    def to_record(self, gfs_array_threshold=None):
+        """Return the ``train_results`` field of a record, and the arrays for GridFS.
+
+        Columns of more than ``gfs_array_threshold`` bytes are returned in a
+        dict to store with save_to_gfs, only their summary stays in the record.
+
+        """
+        n = self.num_rows
+        rec = {'format': 'columnar',
+               'num_steps': n,
+               'steps': _encode_array(self.steps[:n]),
+               'columns': {},
+               'summary': {}}
+        to_gfs = {}
+        for key, (values, present) in self.columns.items():
+            values = values[:n][present[:n]]
+            column = {}
+            if len(values) < n:
+                column['rows'] = _encode_array(np.flatnonzero(present[:n]).astype(np.int32))
+            if gfs_array_threshold is not None and values.nbytes > gfs_array_threshold:
+                column['in_gfs'] = True
+                to_gfs[key] = values
+            else:
+                column.update(_encode_array(values))
+            rec['columns'][key] = column
+            if values.dtype.kind in 'iuf' and len(values):
+                rec['summary'][key] = {'mean': values.mean(), 'min': values.min(),
+                                       'max': values.max(), 'last': values[-1]}
+        if self.objects:
+            rec['objects'] = {key: {'rows': [row for row, _ in items],
+                                    'values': [value for _, value in items]}
+                              for key, items in self.objects.items()}
+        return rec, to_gfs
+
+
+def load_train_results(backend, record):
+    """Return the ``train_results`` of ``record`` as a list of per-step dicts.
+
+    Records saved with the 'columnar' train_results_format are rebuilt from
+    their columns (loading those moved to GridFS); lists are returned as is.
+
+    """
+    train_results = record.get('train_results', [])
+    if isinstance(train_results, list):
+        return train_results
+    results = [{} for _ in range(train_results['num_steps'])]
+    gfs_items = None
+    for key, column in train_results['columns'].items():
+        if column.get('in_gfs'):
+            if gfs_items is None:
+                gfs_items = find_gfs_items(backend, record['_id'])
+            item_key = 'train_results.' + key
+            if item_key in gfs_items:
+                values = load_gfs_item(backend, gfs_items[item_key])
+            else:
+                values = load_gfs_item(backend, gfs_items[None])['train_results'][key]
+        else:
+            values = _decode_array(column)
+        if 'rows' in column:
+            rows = _decode_array(column['rows'])
+        else:
+            rows = range(len(results))
+        for row, value in zip(rows, values):
+            results[row][key] = value
+    for key, items in train_results.get('objects', {}).items():
+        for row, value in zip(items['rows'], items['values']):
+            results[row][key] = value
+    return results
+
+
+def extract_tar_stream(fileobj, path):
+    """Extract the files of a checkpoint tar stream as they arrive.
+
+    Members are read sequentially with ``tarfile`` in stream mode, so the
+    archive itself never touches the disk.  Each member is first written to
+    a hidden temporary file and renamed into place once complete, so an
+    interrupted restore cannot leave behind a partial shard that looks cached.
+
+    Args:
+        fileobj (file-like): Readable stream of a tar archive.
+        path (str): Directory to extract the files into.
+
+    """
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name != member.name:
+                raise ValueError('Unexpected member %s in checkpoint archive' %
+                                 member.name)
+            tmp_path = os.path.join(path, '.' + name + '.part')
+            with open(tmp_path, 'wb') as _fp:
+                shutil.copyfileobj(tar.extractfile(member), _fp)
+            os.rename(tmp_path, os.path.join(path, name))
+    finally:
+        tar.close()
+
+
 def make_mongo_safe(_d):
     """Make a json-izable actually safe for insertion into Mongo.
 
@@ -159,6 +699,59 @@ def make_mongo_safe(_d):
             _d[_k.replace('.', '___')] = _d.pop(_k)
 
 
+def params_hash(sonified_params):
+    """Return a stable content hash of a sonified params document."""
+    dump = json.dumps(sonified_params, sort_keys=True, default=str)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def load_params_doc(backend, params_id):
+    """Fetch the params document ``params_id`` stored in ``backend``.
+
+    Documents are content addressed, so they are cached in memory for the
+    lifetime of the process.
+
+    """
+    if params_id not in _PARAMS_CACHE:
+        doc = backend.get_params(params_id)
+        if doc is None:
+            raise KeyError('No params document with id %s' % params_id)
+        _PARAMS_CACHE[params_id] = doc
+    return _PARAMS_CACHE[params_id]
+
+
+def get_backend(name, host, port, dbname, collname, exp_id, local_root=None):
+    """Return the storage backend ``name`` ('mongo' or 'local') for a location."""
+    if name == 'mongo':
+        if host is None or port is None:
+            raise KeyError('host and port are required by the mongo backend.')
+        return MongoBackend.from_location(host, port, dbname, collname, exp_id)
+    elif name == 'local':
+        return LocalBackend(local_root or LOCAL_BACKEND_ROOT,
+                            dbname, collname, exp_id)
+    raise ValueError('Unsupported storage backend: {}.'.format(name))
+
+
+def mongo_handles(backend):
+    """Return the client and GridFS stores of a MongoBackend, or Nones."""
+    if isinstance(backend, MongoBackend):
+        return backend.conn, backend.collfs, backend.collfs_recent
+    return None, None, None
+
+
+def step_is_due(step, freq, prev_step=None):
+    """Return whether something done every ``freq`` steps is due at ``step``.
+
+    Without ``prev_step``, that is when ``step`` is a multiple of ``freq``.
+    When steps advance by more than one at a time, it is due when a multiple
+    of ``freq`` is in ``(prev_step, step]``.
+
+    """
+    if prev_step is None:
+        return step % freq == 0
+    return step // freq > prev_step // freq
+
+
 def version_check_and_info(module):
     """Return either git info or standard module version if not a git repo.
 
@@ -168,7 +761,13 @@ def version_check_and_info(module):
     Returns:
         dict: dictionary of info
 
+    The info is looked up once per module and process, as git_info is slow on
+    repos with long reflogs.
+
     """
+    if module.__name__ in _MODULE_INFO_CACHE:
+        return copy.deepcopy(_MODULE_INFO_CACHE[module.__name__])
+    import git  # slow to import, only needed here
     srcpath = inspect.getsourcefile(module)
     try:
         repo = git.Repo(srcpath, search_parent_directories=True)
@@ -179,6 +778,7 @@ def version_check_and_info(module):
     else:
         info = git_info(repo)
     info['source_path'] = srcpath
+    _MODULE_INFO_CACHE[module.__name__] = copy.deepcopy(info)
     return info
 
 
@@ -200,7 +800,7 @@ def sonify(arg, memo=None, skip=False):
     if memo is None:
         memo = {}
     if id(arg) in memo:
-        rval = memo[id(arg)]
+        return memo[id(arg)][1]
 
     if isinstance(arg, ObjectId):
         rval = arg
@@ -224,10 +824,15 @@ def sonify(arg, memo=None, skip=False):
     elif isinstance(arg, (basestring, float, int, type(None))):
         rval = arg
     elif isinstance(arg, np.ndarray):
-        if arg.ndim == 0:
+        if arg.dtype.kind == 'b':
+            # bools are stored as ints, like single bools below
+            rval = arg.astype(np.int64).tolist()
+        elif arg.dtype.kind in 'iuf':
+            rval = arg.tolist()
+        elif arg.ndim == 0:
             rval = sonify(arg.sum(), skip=skip)
         else:
-            rval = map(sonify, arg)  # N.B. memo None
+            rval = [sonify(ai, memo, skip) for ai in arg]
     # -- put this after ndarray because ndarray not hashable
     elif arg in (True, False):
         rval = int(arg)
@@ -245,7 +850,9 @@ def sonify(arg, memo=None, skip=False):
     else:
         raise TypeError('sonify', arg)
 
-    memo[id(rval)] = rval
+    if isinstance(arg, (list, tuple, dict, np.ndarray)) or callable(arg):
+        # keep arg alive, so that its id is not reused during this sonify
+        memo[id(arg)] = (arg, rval)
     return rval
 
 
@@ -294,40 +901,69 @@ class DBInterface(object):
             save_params = {}
         if load_params is None:
             load_params = {}
-        location_variables = ['host', 'port', 'dbname', 'collname', 'exp_id']
+        self.backend_name = save_params.get('backend', load_params.get('backend', DEFAULT_SAVE_PARAMS['backend']))
+        self.load_backend_name = load_params.get('backend', self.backend_name)
+        location_variables = ['local_root', 'host', 'port', 'dbname', 'collname', 'exp_id']
+        # not needed by every backend
+        optional_variables = ['local_root', 'host', 'port']
         for _k in location_variables:
             if _k in save_params:
                 sv = save_params[_k]
+            elif _k in optional_variables:
+                sv = load_params.get(_k)
             else:
                 sv = load_params[_k]
             if _k in load_params:
                 lv = load_params[_k]
+            elif _k in optional_variables:
+                lv = save_params.get(_k)
             else:
                 lv = save_params[_k]
             setattr(self, _k, sv)
             setattr(self, 'load_' + _k, lv)
         self.sameloc = all([getattr(self, _k) == getattr(
-            self, 'load_' + _k) for _k in location_variables])
+            self, 'load_' + _k) for _k in location_variables + ['backend_name']])
         if 'query' in load_params and not load_params['query'] is None and 'exp_id' in load_params['query']:
             self.sameloc = self.sameloc & (load_params['query']['exp_id'] == self.exp_id)
 
         for _k in ['do_save', 'save_metrics_freq', 'save_valid_freq', 'cache_filters_freq', 'cache_max_num',
-                   'save_filters_freq', 'save_initial_filters', 'save_to_gfs']:
+                   'save_filters_freq', 'save_initial_filters', 'save_to_gfs', 'stream_upload',
+                   'save_queue_size', 'metrics_buffer_size', 'metrics_buffer_secs', 'dedup_params',
+                   'ensure_indexes', 'delta_recent', 'snapshot_save', 'compression',
+                   'compression_level', 'save_to_gfs_format', 'gfs_array_threshold',
+                   'train_results_format']:
             setattr(self, _k, save_params.get(_k, DEFAULT_SAVE_PARAMS[_k]))
-
-        for _k in ['do_restore', 'from_ckpt', 'to_restore', 'load_param_dict']:
+        if self.save_to_gfs_format not in GFS_FORMATS:
+            raise ValueError('Unknown save_to_gfs_format %s, choose from %s.' %
+                             (self.save_to_gfs_format, GFS_FORMATS))
+        if self.train_results_format not in TRAIN_RESULTS_FORMATS:
+            raise ValueError('Unknown train_results_format %s, choose from %s.' %
+                             (self.train_results_format, TRAIN_RESULTS_FORMATS))
+        if self.compression is not None:
+            # fail now rather than at the first save if the codec is unusable
+            get_compressor(self.compression, self.compression_level)
+
+        for _k in ['do_restore', 'from_ckpt', 'to_restore', 'load_param_dict', 'stream_restore',
+                   'checkpoint_cache_dir', 'checkpoint_cache_bytes']:
             setattr(self, _k, load_params.get(_k, DEFAULT_LOAD_PARAMS[_k]))
 
         self.rec_to_save = None
-        self.checkpoint_thread = None
+        self._train_buffer = None
+        if self.train_results_format == 'columnar':
+            self._train_buffer = TrainResultsBuffer()
+        self.checkpoint_writer = None
         self.outrecs = []
-
-        self.conn = pymongo.MongoClient(host=self.host, port=self.port)
-        self.conn.server_info()
-        self.collfs = gridfs.GridFS(self.conn[self.dbname], self.collname)
-
-        recent_name = '_'.join([self.dbname, self.collname, self.exp_id, '__RECENT'])
-        self.collfs_recent = gridfs.GridFS(self.conn[recent_name])
+        self._metrics_buffer = []
+        self._metrics_buffer_time = None
+        self._params_id = None
+        self._delta_base = None
+        self._snapshot_fn = None
+        self._snapshot_writer = None
+        self._snapshot_pending = False
+
+        self.backend = get_backend(self.backend_name, self.host, self.port,
+                                   self.dbname, self.collname, self.exp_id,
+                                   local_root=self.local_root)
 
         self.load_data = None
         load_query = load_params.get('query')
@@ -344,20 +980,17 @@ class DBInterface(object):
             load_query.update({'exp_id': self.load_exp_id})
 
         self.load_query = load_query
-        if self.load_host != self.host or self.port != self.load_port:
-            self.load_conn = pymongo.MongoClient(host=self.load_host,
-                                                 port=self.load_port)
-            self.load_conn.server_info()
-        else:
-            self.load_conn = self.conn
-        self.load_collfs = gridfs.GridFS(self.load_conn[self.load_dbname],
-                                         self.load_collname)
-        load_recent_name = '_'.join([self.load_dbname,
-                                     self.load_collname,
-                                     self.load_exp_id,
-                                     '__RECENT'])
-        self.load_collfs_recent = gridfs.GridFS(
-            self.load_conn[load_recent_name])
+        self.load_backend = get_backend(self.load_backend_name, self.load_host, self.load_port,
+                                        self.load_dbname, self.load_collname, self.load_exp_id,
+                                        local_root=self.load_local_root)
+
+        # the pymongo/gridfs handles of the mongo backends
+        self.conn, self.collfs, self.collfs_recent = mongo_handles(self.backend)
+        self.load_conn, self.load_collfs, self.load_collfs_recent = mongo_handles(self.load_backend)
+
+        if self.ensure_indexes:
+            self.backend.ensure_indexes()
+            self.load_backend.ensure_indexes()
 
         if (save_params == {}) and ('cache_dir' in load_params): # use cache_dir from load params if save_params not given
             cache_dir = load_params['cache_dir']
@@ -367,8 +1000,12 @@ class DBInterface(object):
             cache_dir = None
 
         if not cache_dir:
+            if self.backend_name == 'mongo':
+                location = '%s:%d' % (self.host, self.port)
+            else:
+                location = self.backend_name
             self.cache_dir = os.path.join(TFUTILS_HOME,
-                                          '%s:%d' % (self.host, self.port),
+                                          location,
                                           self.dbname,
                                           self.collname,
                                           self.exp_id)
@@ -376,6 +1013,9 @@ class DBInterface(object):
             self.cache_dir = cache_dir
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
+        self.checkpoint_cache = CheckpointCache(
+                self.checkpoint_cache_dir or CHECKPOINT_CACHE_ROOT,
+                max_bytes=self.checkpoint_cache_bytes)
 
     def load_rec(self):
         # first try and see if anything with the save data exists, since obviously
@@ -387,8 +1027,7 @@ class DBInterface(object):
         if not load and not self.sameloc:
             load = self.load_from_db(self.load_query,
                                      cache_filters=True,
-                                     collfs=self.load_collfs,
-                                     collfs_recent=self.load_collfs_recent)
+                                     backend=self.load_backend)
             if load is None:
                 raise Exception('You specified load parameters but no '
                                 'record was found with the given spec.')
@@ -563,7 +1202,8 @@ class DBInterface(object):
                      query,
                      cache_filters=False,
                      collfs=None,
-                     collfs_recent=None):
+                     collfs_recent=None,
+                     backend=None):
         """Load checkpoint from the database.
 
         Checks the recent and regular checkpoint fs to find the latest one
@@ -572,73 +1212,222 @@ class DBInterface(object):
 
         Args:
             query: dict expressing MongoDB query
+            collfs, collfs_recent (gridfs.GridFS, optional): Mongo stores to
+                load from instead of those of ``backend``.
+            backend (StorageBackend, optional): Defaults to ``self.backend``.
         """
-        if collfs is None:
-            collfs = self.collfs
-        coll = collfs._GridFS__files
-        if collfs_recent is None:
-            collfs_recent = self.collfs_recent
-        coll_recent = collfs_recent._GridFS__files
+        if backend is None:
+            if collfs is None and collfs_recent is None:
+                backend = self.backend
+            else:
+                backend = MongoBackend(collfs or self.collfs,
+                                       collfs_recent or self.collfs_recent)
 
         query['saved_filters'] = True
-        count = collfs.find(query).count()
-        if count > 0:  # get latest that matches query
-            ckpt_record = coll.find(query, sort=[('uploadDate', -1)])[0]
-            loading_from = coll
-        else:
-            ckpt_record = None
+        # get latest that matches query
+        ckpt_record = backend.find_latest_checkpoint(query)
+        from_recent = False
 
         try:
-            count_recent = collfs_recent.find(query).count()
-        except Exception as inst:
+            ckpt_record_recent = backend.find_latest_checkpoint(query, recent=True)
+        except er.PyMongoError as inst:
+            # errors of other backends are raised unchanged
             raise er.OperationFailure(inst.args[0] + "\n Is your dbname too long? Mongo requires that dbnames be no longer than 64 characters.")
-        if count_recent > 0:  # get latest that matches query
-            ckpt_record_recent = coll_recent.find(query, sort=[('uploadDate', -1)])[0]
+        if ckpt_record_recent is not None:
             # use the record with latest timestamp
             if ckpt_record is None or ckpt_record_recent['uploadDate'] > ckpt_record['uploadDate']:
-                loading_from = coll_recent
+                from_recent = True
                 ckpt_record = ckpt_record_recent
 
-        if count + count_recent == 0:  # no matches for query
+        if ckpt_record is None:  # no matches for query
             log.warning('No matching checkpoint for query "{}"'.format(repr(query)))
             return
 
-        database = loading_from._Collection__database
-        log.info('Loading checkpoint from %s' % loading_from.full_name)
+        log.info('Loading checkpoint from %s' % backend.full_name(recent=from_recent))
+        self.resolve_params(ckpt_record, backend=backend)
 
         if cache_filters:
-            filename = os.path.basename(ckpt_record['filename'])
-            cache_filename = os.path.join(self.cache_dir, filename)
-
-            # check if there is no local copy
-            if not os.path.isfile(cache_filename):
-                log.info('No cache file at %s, loading from DB' % cache_filename)
-                # create new file to write from gridfs
-                load_dest = open(cache_filename, "w+")
-                load_dest.close()
-                load_dest = open(cache_filename, 'rwb+')
-                fsbucket = gridfs.GridFSBucket(database, bucket_name=loading_from.name.split('.')[0])
-                fsbucket.download_to_stream(ckpt_record['_id'], load_dest)
-                load_dest.close()
-                if ckpt_record['_saver_write_version'] == saver_pb2.SaverDef.V2:
-                    assert cache_filename.endswith('.tar')
-                    tar = tarfile.open(cache_filename)
-                    tar.extractall(path=self.cache_dir)
-                    tar.close()
-                    cache_filename = os.path.splitext(cache_filename)[0]
-                    verify_pb2_v2_files(cache_filename, ckpt_record)
-            else:
-                if ckpt_record['_saver_write_version'] == saver_pb2.SaverDef.V2:
-                    cache_filename = os.path.splitext(cache_filename)[0]
-                    verify_pb2_v2_files(cache_filename, ckpt_record)
-                log.info('Cache file found at %s, using that to load' %
-                         cache_filename)
+            cache_filename = self._cache_checkpoint(backend, ckpt_record, from_recent)
         else:
             cache_filename = None
         return ckpt_record, cache_filename
 
-    def save(self, train_res=None, valid_res=None, step=None, validation_only=False):
-        """Actually save record into DB and makes local filter caches."""
+    def _cache_checkpoint(self, backend, ckpt_record, recent):
+        """Return the path of the checkpoint of ``ckpt_record`` in the checkpoint cache.
+
+        Delta checkpoints are merged with their (cached) base checkpoint, so the
+        cache always holds complete checkpoints.
+
+        """
+        filename = os.path.basename(ckpt_record['filename'])
+        is_v2 = ckpt_record['_saver_write_version'] == saver_pb2.SaverDef.V2
+        if is_v2:
+            assert filename.endswith('.tar')
+            filename = os.path.splitext(filename)[0]
+
+        def fetch(path):
+            log.info('No cache entry for %s, loading from DB' % ckpt_record['_id'])
+            if '_delta_base' in ckpt_record:
+                load_path = tempfile.mkdtemp(dir=path)
+            else:
+                load_path = path
+            if is_v2 and self.stream_restore:
+                # extract the shards straight from the download stream
+                grid_out = open_file(backend, ckpt_record, recent=recent)
+                try:
+                    extract_tar_stream(grid_out, load_path)
+                finally:
+                    grid_out.close()
+            else:
+                load_filename = os.path.join(load_path, os.path.basename(ckpt_record['filename']))
+                with open(load_filename, 'wb') as load_dest:
+                    if ckpt_record.get('compression'):
+                        grid_out = open_file(backend, ckpt_record, recent=recent)
+                        try:
+                            shutil.copyfileobj(grid_out, load_dest, CHUNK_SIZE)
+                        finally:
+                            grid_out.close()
+                    else:
+                        backend.download_to_stream(ckpt_record, load_dest, recent=recent)
+                if is_v2:
+                    tar = tarfile.open(load_filename)
+                    tar.extractall(path=load_path)
+                    tar.close()
+                    os.remove(load_filename)
+            if is_v2:
+                verify_pb2_v2_files(os.path.join(load_path, filename), ckpt_record)
+
+            if '_delta_base' in ckpt_record:
+                base_records = list(backend.find({'_id': ckpt_record['_delta_base']}))
+                if not base_records:
+                    raise ValueError('Base checkpoint %s of delta checkpoint %s not found' %
+                                     (ckpt_record['_delta_base'], ckpt_record['_id']))
+                base_path = self._cache_checkpoint(backend, base_records[0], False)
+                log.info('Merging delta checkpoint %s onto %s' % (ckpt_record['_id'], base_path))
+                merge_delta_checkpoint(base_path,
+                                       os.path.join(load_path, filename),
+                                       os.path.join(path, filename))
+                shutil.rmtree(load_path)
+
+        cache_path = self.checkpoint_cache.get(str(ckpt_record['_id']), fetch)
+        cache_filename = os.path.join(cache_path, filename)
+        log.info('Using cached checkpoint %s' % cache_filename)
+        return cache_filename
+
+    def resolve_params(self, rec, backend=None):
+        """Fill in ``rec['params']`` for records saved with deduplicated params.
+
+        Args:
+            rec (dict): Record as found in the database.
+            backend (StorageBackend, optional): Backend storing the params.
+                Defaults to ``self.backend``.
+
+        Returns:
+            dict: ``rec``, with ``params`` set.
+
+        """
+        if 'params' not in rec and 'params_id' in rec:
+            if backend is None:
+                backend = self.backend
+            rec['params'] = load_params_doc(backend, rec['params_id'])
+        return rec
+
+    @property
+    def params_id(self):
+        """Id of the params document, stored once in the params collection."""
+        if self._params_id is None:
+            params_id = params_hash(self.sonified_params)
+            doc = sonify(self.sonified_params, skip=True)
+            make_mongo_safe(doc)
+            self.backend.put_params(params_id, doc)
+            _PARAMS_CACHE[params_id] = doc
+            self._params_id = params_id
+        return self._params_id
+
+    def snapshot(self):
+        """Copy the values of the saved variables into host memory.
+
+        All values are fetched with a single ``sess.run``, so they come from the
+        same step and the checkpoint can then be written without the session.
+
+        Returns:
+            dict: numpy values of the variables, keyed by checkpoint name.
+
+        """
+        if self._snapshot_fn is None:
+            var_list = self.var_list
+            if var_list is None:
+                var_list = variables._all_saveable_objects()
+            if isinstance(var_list, dict):
+                names_to_vars = dict(var_list)
+            else:
+                names_to_vars = saver_lib.BaseSaverBuilder.OpListToDict(var_list)
+            for name, var in names_to_vars.items():
+                if not isinstance(var, variables.Variable):
+                    raise ValueError('Snapshots only support plain variables, '
+                                     'not %s (%s).' % (name, type(var)))
+            names = sorted(names_to_vars)
+            self._snapshot_fn = self.sess.make_callable(
+                    [names_to_vars[name] for name in names])
+            self._snapshot_writer = ArrayCheckpointWriter(
+                    {name: (names_to_vars[name].dtype.base_dtype,
+                            names_to_vars[name].get_shape())
+                     for name in names})
+        return dict(zip(self._snapshot_writer.names, self._snapshot_fn()))
+
+    def _record_to_save(self):
+        """Return the record accumulating results until the next save."""
+        if self.rec_to_save is None:
+            self.rec_to_save = {'exp_id': self.exp_id,
+                                'saved_filters': False,
+                                'duration': time.time() - self.start_time_step}
+            if self.dedup_params:
+                self.rec_to_save['params_id'] = self.params_id
+            else:
+                self.rec_to_save['params'] = self.sonified_params
+        return self.rec_to_save
+
+    def _add_train_results(self, rec, step, step_res):
+        if self._train_buffer is not None:
+            self._train_buffer.append(step, step_res)
+        else:
+            rec.setdefault('train_results', []).append(step_res)
+
+    @staticmethod
+    def _step_train_results(train_res):
+        """Return the entry of `train_res` in ``train_results``.
+
+        The results of the train ops are dropped, and arrays (e.g. per-example
+        losses) are replaced by their mean.
+
+        """
+        step_res = {}
+        for k, v in train_res.items():
+            if k in ('optimizer', '__grads__'):
+                continue
+            if isinstance(v, np.ndarray) and len(v) > 1:
+                v = np.mean(v)
+            step_res[k] = v
+        return step_res
+
+    def is_save_step(self, step, prev_step=None):
+        """Return whether `save` writes a training record at ``step``."""
+        if not self.do_save:
+            return False
+        initial = step > 0 or (self.save_initial_filters and not self.load_data)
+        return any(step_is_due(step, freq, prev_step) for freq in
+                   [self.save_metrics_freq, self.save_valid_freq]) or \
+            (initial and any(step_is_due(step, freq, prev_step) for freq in
+                             [self.save_filters_freq, self.cache_filters_freq]))
+
+    def save(self, train_res=None, valid_res=None, step=None, validation_only=False,
+             prev_step=None):
+        """Actually save record into DB and makes local filter caches.
+
+        ``prev_step`` is the step of the previous call, when steps advance by
+        more than one between calls (see `step_is_due`).
+
+        """
         if train_res is None:
             train_res = {}
         if valid_res is None:
@@ -650,42 +1439,33 @@ class DBInterface(object):
                                         ' tensorflow operation to the saver.')
             step = self.global_step.eval(session=self.sess)
 
+        if self.do_save and not (validation_only or valid_res or
+                                 self.is_save_step(step, prev_step)):
+            # Nothing is written at this step: only keep the results for the next record
+            rec = self._record_to_save()
+            rec['step'] = step
+            if train_res:
+                self._add_train_results(rec, step, self._step_train_results(train_res))
+            return
+
         train_res = copy.copy(train_res)
         valid_res = {_k: copy.copy(_v) for _k, _v in valid_res.items()}
         duration = time.time() - self.start_time_step
 
-        if self.rec_to_save is None:
-            rec = {'exp_id': self.exp_id,
-                   'params': self.sonified_params,
-                   'saved_filters': False,
-                   'duration': duration}
-            self.rec_to_save = rec
-        else:
-            rec = self.rec_to_save
+        rec = self._record_to_save()
         rec['step'] = step
 
         if len(train_res) > 0:
             # TODO: also include error rate of the train set to monitor overfitting
             message = 'Step {} ({:.0f} ms) -- '.format(step, 1000 * duration)
-
-            # If ndarray found, get the mean of it
-            for k, v in train_res.items():
-                if k not in ['optimizer', '__grads__'] and \
-                        isinstance(v, np.ndarray) and len(v) > 1:
-                    train_res[k] = np.mean(v)
+            train_res = self._step_train_results(train_res)
 
             msg2 = ['{}: {:.4f}'.format(k, v) for k, v in train_res.items()
-                    if k not in ['optimizer', '__grads__'] and k not in self.save_to_gfs]
+                    if k not in self.save_to_gfs]
             message += ', '.join(msg2)
             log.info(message)
 
-            if '__grads__' in train_res:
-                del train_res['__grads__']
-            if 'optimizer' in train_res:
-                del train_res['optimizer']
-            if 'train_results' not in rec:
-                rec['train_results'] = []
-            rec['train_results'].append(train_res)
+            self._add_train_results(rec, step, train_res)
 
         # print validation set performance
         if len(valid_res) > 0:
@@ -701,25 +1481,40 @@ class DBInterface(object):
             save_filters_permanent = save_filters_tmp = False
             need_to_save = True
         else:
-            save_filters_permanent = ((step % self.save_filters_freq == 0) and
+            save_filters_permanent = (step_is_due(step, self.save_filters_freq, prev_step) and
                                       (step > 0 or (self.save_initial_filters and not self.load_data)))
-            save_filters_tmp = ((step % self.cache_filters_freq == 0) and
+            save_filters_tmp = (step_is_due(step, self.cache_filters_freq, prev_step) and
                                 (step > 0 or (self.save_initial_filters and not self.load_data)))
-            save_metrics_now = step % self.save_metrics_freq == 0
-            save_valid_now = step % self.save_valid_freq == 0
+            save_metrics_now = step_is_due(step, self.save_metrics_freq, prev_step)
+            save_valid_now = step_is_due(step, self.save_valid_freq, prev_step)
             need_to_save = save_filters_permanent or save_filters_tmp or save_metrics_now or save_valid_now
 
         need_to_save = self.do_save and need_to_save
 
         if need_to_save:
             self.rec_to_save = None
-            self.sync_with_host()
+            snapshot = None
+            if save_filters_permanent or save_filters_tmp:
+                if self.snapshot_save:
+                    if self._snapshot_pending:
+                        # Keep at most one snapshot of the model in host memory
+                        self.sync_with_host()
+                    self._snapshot_pending = True
+                    snapshot = self.snapshot()
+                else:
+                    # The checkpoint is written when the job starts, so let earlier
+                    # jobs finish first to keep it close to ``step``.
+                    self.sync_with_host()
             save_to_gfs = {}
             for _k in self.save_to_gfs:
                 if train_res:
                     if 'train_results' not in save_to_gfs:
                         save_to_gfs['train_results'] = {}
-                    if _k in train_res:
+                    if self._train_buffer is not None:
+                        values = self._train_buffer.pop(_k)
+                        if values:
+                            save_to_gfs['train_results'][_k] = values
+                    elif _k in train_res:
                         save_to_gfs['train_results'][_k] = [r.pop(_k) for r in rec['train_results'] if _k in r]
                         if len(save_to_gfs['train_results'][_k]) == 1:
                             save_to_gfs['train_results'][_k] == save_to_gfs['train_results'][_k][0]
@@ -731,120 +1526,539 @@ class DBInterface(object):
                             save_to_gfs['validation_results'][_vk] = {}
                         if _k in valid_res[_vk]:
                             save_to_gfs['validation_results'][_vk][_k] = valid_res[_vk].pop(_k)
+            if self._train_buffer is not None and len(self._train_buffer):
+                rec['train_results'], to_gfs = self._train_buffer.to_record(
+                        self.gfs_array_threshold)
+                if to_gfs:
+                    save_to_gfs.setdefault('train_results', {}).update(to_gfs)
+                self._train_buffer.clear()
+            if self.gfs_array_threshold is not None:
+                # large arrays go to GridFS instead of bloating the record
+                for _vk, _vres in valid_res.items():
+                    for _k, _v in _vres.items():
+                        if isinstance(_v, np.ndarray) and _v.nbytes > self.gfs_array_threshold:
+                            save_to_gfs.setdefault('validation_results', {}) \
+                                       .setdefault(_vk, {})[_k] = _vres.pop(_k)
 
             save_rec = sonify(rec, skip=self._skip_check)
             make_mongo_safe(save_rec)
 
-            coord = tf.train.Coordinator()
-            thread = CoordinatedThread(coord=coord,
-                                       target=self._save_thread,
-                                       args=(save_filters_permanent,
-                                             save_filters_tmp,
-                                             save_rec,
-                                             step,
-                                             save_to_gfs))
-            thread.daemon = True
-            thread.start()
-            self.checkpoint_thread = thread
-            self.checkpoint_coord = coord
+            if self.checkpoint_writer is None:
+                on_idle = None
+                if self.metrics_buffer_size > 1:
+                    # flush buffered records by age even when no record follows
+                    on_idle = self._flush_old_metrics
+                self.checkpoint_writer = CheckpointWriter(
+                        max_queue_size=self.save_queue_size,
+                        on_idle=on_idle,
+                        idle_secs=min(1., self.metrics_buffer_secs))
+            self.checkpoint_writer.submit(
+                    self._save_thread,
+                    args=(save_filters_permanent,
+                          save_filters_tmp,
+                          save_rec,
+                          step,
+                          save_to_gfs,
+                          snapshot),
+                    desc='step %s' % step)
 
     def sync_with_host(self):
-        if self.checkpoint_thread is not None:
+        """Wait until all queued save jobs have been written."""
+        if self.checkpoint_writer is not None:
             try:
-                self.checkpoint_coord.join([self.checkpoint_thread])
+                if self.metrics_buffer_size > 1:
+                    self.checkpoint_writer.submit(self._flush_metrics,
+                                                  desc='flush metrics')
+                self.checkpoint_writer.join()
             except Exception as error:
                 log.warning('A checkpoint thead raised an exception '
                             'while saving a checkpoint.')
                 log.error(error)
                 raise
-            else:
-                self.checkpoint_thread = None
+            finally:
+                # all jobs are done or dropped, none holds a snapshot
+                self._snapshot_pending = False
+
+    def close(self):
+        """Write all queued save jobs and stop the background writer.
+
+        Raises the error of a failed save job, if any was not raised yet.
+
+        """
+        try:
+            if self.checkpoint_writer is not None:
+                try:
+                    self.sync_with_host()
+                finally:
+                    writer, self.checkpoint_writer = self.checkpoint_writer, None
+                    writer.close()
+        finally:
+            self.checkpoint_cache.release()
+            if self._snapshot_writer is not None:
+                self._snapshot_writer.close()
+                self._snapshot_fn = self._snapshot_writer = None
+
+    def _buffer_metrics(self, save_rec):
+        """Add a metrics-only record to the bulk insert buffer.
+
+        The record ``_id`` is assigned here, so it can be reported in
+        ``outrecs`` before the buffer is flushed.
+
+        """
+        save_rec['_id'] = ObjectId()
+        if not self._metrics_buffer:
+            self._metrics_buffer_time = time.time()
+        self._metrics_buffer.append(save_rec)
+        if len(self._metrics_buffer) >= self.metrics_buffer_size or \
+                time.time() - self._metrics_buffer_time >= self.metrics_buffer_secs:
+            self._flush_metrics()
+        return save_rec['_id']
+
+    def _flush_old_metrics(self):
+        """Flush the buffered records once the oldest is metrics_buffer_secs old."""
+        if self._metrics_buffer and \
+                time.time() - self._metrics_buffer_time >= self.metrics_buffer_secs:
+            self._flush_metrics()
+
+    def _flush_metrics(self):
+        """Insert all buffered metrics-only records with one ``insert_many``."""
+        if self._metrics_buffer:
+            log.info('Inserting %d records into database.' % len(self._metrics_buffer))
+            self.backend.insert_records(self._metrics_buffer)
+            self._metrics_buffer = []
+        self._metrics_buffer_time = None
+
+    def _save_thread(self, save_filters_permanent, save_filters_tmp, save_rec, step, save_to_gfs,
+                     snapshot=None):
+        metrics_only = not (save_filters_permanent or save_filters_tmp or save_to_gfs)
+        if self.metrics_buffer_size > 1 and not metrics_only:
+            # keep the records in the database in the order they were saved
+            self._flush_metrics()
 
-    def _save_thread(self, save_filters_permanent, save_filters_tmp, save_rec, step, save_to_gfs):
         if save_filters_permanent or save_filters_tmp:
             save_rec['saved_filters'] = True
             save_path = os.path.join(self.cache_dir, 'checkpoint')
             log.info('Saving model with path prefix %s ... ' % save_path)
-            saved_path = self.tf_saver.save(self.sess,
-                                            save_path=save_path,
-                                            global_step=step,
-                                            write_meta_graph=False)
+            if snapshot is not None:
+                saved_path = self._snapshot_writer.save(snapshot, save_path,
+                                                        global_step=step)
+                write_version = saver_pb2.SaverDef.V2
+            else:
+                saved_path = self.tf_saver.save(self.sess,
+                                                save_path=save_path,
+                                                global_step=step,
+                                                write_meta_graph=False)
+                write_version = self.tf_saver._write_version
             log.info('... done saving with path prefix %s' % saved_path)
-            putfs = self.collfs if save_filters_permanent else self.collfs_recent
-            log.info('Putting filters into %s database' % repr(putfs))
-            save_rec['_saver_write_version'] = self.tf_saver._write_version
-            if self.tf_saver._write_version == saver_pb2.SaverDef.V2:
+            recent = not save_filters_permanent
+            log.info('Putting filters into %s database' % self.backend.full_name(recent=recent))
+            save_rec['_saver_write_version'] = write_version
+            if write_version == saver_pb2.SaverDef.V2:
                 file_data = get_saver_pb2_v2_files(saved_path)
-                save_rec['_saver_num_data_files'] = file_data['num_data_files']
+                upload_data = file_data
+                delta_dir = None
+                if self.delta_recent and recent and self._delta_base is not None:
+                    # only upload the variables changed since the last permanent checkpoint
+                    delta_dir = tempfile.mkdtemp(dir=self.cache_dir)
+                    delta_path, changed = write_delta_checkpoint(
+                            saved_path, self._delta_base['digests'],
+                            os.path.join(delta_dir, os.path.basename(saved_path)))
+                    log.info('Delta checkpoint against %s: %d variables changed' %
+                             (self._delta_base['_id'], len(changed)))
+                    save_rec['_delta_base'] = self._delta_base['_id']
+                    upload_data = get_saver_pb2_v2_files(delta_path)
+                save_rec['_saver_num_data_files'] = upload_data['num_data_files']
                 tarfilepath = saved_path + '.tar'
-                tar = tarfile.open(tarfilepath, 'w')
-                for _f in file_data['files']:
-                    tar.add(_f, arcname=os.path.split(_f)[1])
-                tar.close()
-                with open(tarfilepath, 'rb') as _fp:
-                    outrec = putfs.put(_fp, filename=tarfilepath, **save_rec)
+                if self.stream_upload:
+                    outrec = put_tar_stream(self.backend, upload_data['files'],
+                                            compression=self.compression,
+                                            compression_level=self.compression_level,
+                                            recent=recent, filename=tarfilepath,
+                                            **save_rec)
+                else:
+                    tar = tarfile.open(tarfilepath, 'w')
+                    for _f in upload_data['files']:
+                        tar.add(_f, arcname=os.path.split(_f)[1])
+                    tar.close()
+                    with open(tarfilepath, 'rb') as _fp:
+                        outrec = put_file(self.backend, _fp,
+                                          compression=self.compression,
+                                          compression_level=self.compression_level,
+                                          recent=recent, filename=tarfilepath,
+                                          **save_rec)
             else:
                 with open(saved_path, 'rb') as _fp:
-                    outrec = putfs.put(_fp, filename=saved_path, **save_rec)
+                    outrec = put_file(self.backend, _fp,
+                                      compression=self.compression,
+                                      compression_level=self.compression_level,
+                                      recent=recent, filename=saved_path,
+                                      **save_rec)
             log.info('... done putting filters into database.')
+            if write_version == saver_pb2.SaverDef.V2:
+                self.checkpoint_cache.add(str(outrec), file_data['files'])
+                if delta_dir is not None:
+                    shutil.rmtree(delta_dir)
+                if self.delta_recent and not recent:
+                    self._delta_base = {'_id': outrec,
+                                        'digests': checkpoint_digests(saved_path)}
+                if snapshot is not None:
+                    # unlike tf_saver, nothing else deletes old snapshot files
+                    for _f in file_data['files']:
+                        os.remove(_f)
+                    self._snapshot_pending = False
+            else:
+                self.checkpoint_cache.add(str(outrec), [saved_path])
 
-            if not save_filters_permanent:
-                recent_gridfs_files = self.collfs_recent._GridFS__files
-                recent_query_result = recent_gridfs_files.find({'saved_filters': True}, sort=[('uploadDate', 1)])
-                num_cached_filters = recent_query_result.count()
-                cache_max_num = self.cache_max_num
-                if num_cached_filters > cache_max_num:
-                    log.info('Cleaning up cached filters')
-                    fsbucket = gridfs.GridFSBucket(recent_gridfs_files._Collection__database, bucket_name=recent_gridfs_files.name.split('.')[0])
-
-                    for del_indx in xrange(0, num_cached_filters - cache_max_num):
-                        #log.info(recent_query_result[del_indx]['uploadDate'])
-                        fsbucket.delete(recent_query_result[del_indx]['_id'])
+            if recent:
+                self.backend.prune_recent(self.cache_max_num)
 
         if not save_filters_permanent:
             save_rec['saved_filters'] = False
-            log.info('Inserting record into database.')
-            outrec = self.collfs._GridFS__files.insert_one(save_rec)
-
-        if not isinstance(outrec, ObjectId):
-            outrec = outrec.inserted_id
+            if self.metrics_buffer_size > 1 and metrics_only:
+                outrec = self._buffer_metrics(save_rec)
+            else:
+                log.info('Inserting record into database.')
+                outrec = self.backend.insert_records([save_rec])[0]
 
         if save_to_gfs:
             idval = str(outrec)
             save_to_gfs_path = idval + "_fileitems"
-            self.collfs.put(cPickle.dumps(save_to_gfs),
-                            filename=save_to_gfs_path, item_for=outrec)
+            if self.save_to_gfs_format == 'npy':
+                put_gfs_items(self.backend, save_to_gfs, save_to_gfs_path, outrec,
+                              compression=self.compression,
+                              compression_level=self.compression_level)
+            else:
+                put_file(self.backend, cPickle.dumps(save_to_gfs),
+                         compression=self.compression,
+                         compression_level=self.compression_level,
+                         filename=save_to_gfs_path, item_for=outrec)
 
         sys.stdout.flush()  # flush the stdout buffer
         self.outrecs.append(outrec)
 
 
-class CoordinatedThread(threading.Thread):
-    """A thread class coordinated by tf.train.Coordinator."""
-
-    def __init__(
-            self, coord=None, group=None, 
-            target=None, name=None, args=(), kwargs={}):
-        super(CoordinatedThread, self).__init__(
-            group=None, target=target, name=name, args=args, kwargs=kwargs)
-        self._coord = coord
-        self._target = target
-        self._args = args
-        self._kwargs = kwargs
-
-    def run(self):
-        """Run the thread's main activity.
-        You may override this method in a subclass. The standard run() method
-        invokes the callable object passed to the object's constructor as the
-        target argument, if any, with sequential and keyword arguments taken
-        from the args and kwargs arguments, respectively.
+class ArrayCheckpointWriter(object):
+    """Write V2 checkpoints of numpy arrays with a graph and session of its own.
+
+    The arrays are fed straight into a ``SaveV2`` op, so neither the model
+    graph nor its session is used, and the graph is built once for all saves.
+
+    Args:
+        specs (dict): ``(dtype, shape)`` of each variable, keyed by name.
+
+    """
+
+    def __init__(self, specs):
+        self.names = sorted(specs)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._prefix = tf.placeholder(tf.string, shape=())
+            self._placeholders = [tf.placeholder(specs[name][0], shape=specs[name][1])
+                                  for name in self.names]
+            self._save_op = io_ops.save_v2(self._prefix, self.names,
+                                           [''] * len(self.names),
+                                           self._placeholders)
+        self.sess = tf.Session(graph=self.graph)
+
+    def save(self, arrays, save_path, global_step=None):
+        """Write ``arrays`` at ``save_path`` (suffixed with ``-global_step``)."""
+        if global_step is not None:
+            save_path = '%s-%d' % (save_path, global_step)
+        feed_dict = {placeholder: arrays[name] for name, placeholder
+                     in zip(self.names, self._placeholders)}
+        feed_dict[self._prefix] = save_path
+        self.sess.run(self._save_op, feed_dict=feed_dict)
+        return save_path
+
+    def close(self):
+        self.sess.close()
+
+
+class CheckpointWriter(object):
+    """A long-lived background thread running save jobs in order.
+
+    Jobs are kept in a bounded queue, so ``submit`` only blocks (applying
+    backpressure to the caller) when ``max_queue_size`` jobs are already
+    pending.  An exception raised by a job is re-raised by the next call to
+    ``submit``, ``join`` or ``close``; jobs queued after a failed one are
+    dropped (and logged).
+
+    Args:
+        max_queue_size (int, default: 16): Maximal number of pending jobs.
+            If <= 0, the queue is unbounded.
+        name (str, optional): Name of the worker thread.
+        on_idle (callable, optional): Called by the worker thread after each
+            ``idle_secs`` seconds without jobs.
+        idle_secs (float, default: 1): See ``on_idle``.
+
+    """
+
+    def __init__(self, max_queue_size=16, name='tfutils_checkpoint_writer',
+                 on_idle=None, idle_secs=1.):
+        self._queue = Queue.Queue(maxsize=max(max_queue_size, 0))
+        self._on_idle = on_idle
+        self._idle_secs = idle_secs
+        self._error = None
+        self.num_jobs = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.last_latency = None
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        """Number of jobs waiting to be run."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return queue depth and latency (seconds from submit to done) of jobs."""
+        mean_latency = self.total_latency / self.num_jobs if self.num_jobs else None
+        return {'num_jobs': self.num_jobs,
+                'queue_depth': self.queue_depth,
+                'last_latency': self.last_latency,
+                'mean_latency': mean_latency,
+                'max_latency': self.max_latency}
+
+    def submit(self, target, args=(), desc=None):
+        """Queue ``target(*args)``, blocking only while the queue is full."""
+        self._raise_error()
+        self._queue.put((time.time(), target, args, desc))
+
+    def join(self):
+        """Block until all queued jobs are done."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Stop the worker thread once the queued jobs are done."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            if self._on_idle is None:
+                job = self._queue.get()
+            else:
+                try:
+                    job = self._queue.get(timeout=self._idle_secs)
+                except Queue.Empty:
+                    if self._error is None:
+                        try:
+                            self._on_idle()
+                        except Exception as error:
+                            log.exception('Idle job raised an exception.')
+                            self._error = error
+                    continue
+            try:
+                if job is None:
+                    return
+                submit_time, target, args, desc = job
+                if self._error is not None:
+                    log.warning('Dropping save job (%s) after an earlier save job failed.'
+                                % desc)
+                    continue
+                start_time = time.time()
+                target(*args)
+                end_time = time.time()
+                latency = end_time - submit_time
+                self.num_jobs += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.last_latency = latency
+                log.info('Save job (%s) done in %.2fs (%.2fs queued, %d pending)' %
+                         (desc, latency, start_time - submit_time, self.queue_depth))
+            except Exception as error:
+                log.exception('Save job raised an exception.')
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+
+class CheckpointCache(object):
+    """A size-capped checkpoint cache shared by the processes of a node.
+
+    Each checkpoint is kept in its own directory ``<root>/<key>``, where
+    ``key`` is the checkpoint ``_id``.  Entries are downloaded into a hidden
+    temporary directory and renamed into place once complete, while holding
+    a per-key exclusive ``fcntl`` creation lock, so concurrent jobs needing
+    the same checkpoint wait for a single download.  When the entries exceed
+    ``max_bytes``, the least recently used ones are evicted.  The entry last
+    returned by `get` keeps a separate shared pin lock until the next `get`
+    (or `release`), so that no process evicts it while it is being restored.
+
+    Args:
+        root (str): Directory of the cache.
+        max_bytes (int, optional): Byte budget of the cache. If None, nothing
+            is evicted.
+
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._held_lock = None
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+
+    def stats(self):
+        """Return the number of cache hits and misses of this process."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def _lock(self, name, blocking=True, shared=False):
+        """Return an open file holding an exclusive (or shared) lock on ``name``, or None."""
+        lock_file = open(os.path.join(self.root, '.' + name + '.lock'), 'a')
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except IOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _create(self, key, fill):
+        """Create entry ``key`` with ``fill(path)`` unless it exists.
+
+        The entry is filled while holding its exclusive creation lock, which
+        is released once the entry is renamed into place.  The entry is then
+        pinned with a shared lock, distinct from the creation lock.
+
+        Returns:
+            (bool, file): Whether the entry already existed, and an open file
+            holding the shared pin lock on the entry, which keeps it from
+            being evicted until it is closed.
+
+        """
+        path = self.entry_path(key)
+        existed = True
+        while True:
+            if not os.path.isdir(path):
+                create_lock = self._lock(key + '.create')
+                try:
+                    # another process may have created it while we were waiting
+                    if not os.path.isdir(path):
+                        tmp_path = tempfile.mkdtemp(prefix='.' + key + '.', dir=self.root)
+                        try:
+                            fill(tmp_path)
+                            os.rename(tmp_path, path)
+                        except Exception:
+                            shutil.rmtree(tmp_path, ignore_errors=True)
+                            raise
+                        existed = False
+                finally:
+                    create_lock.close()
+            lock_file = self._lock(key, shared=True)
+            # the entry may have been evicted, along with its lock file,
+            # before it was pinned
+            try:
+                pinned = os.path.isdir(path) and \
+                    os.fstat(lock_file.fileno()).st_ino == os.stat(lock_file.name).st_ino
+            except OSError:
+                pinned = False
+            if pinned:
+                return existed, lock_file
+            lock_file.close()
+
+    def get(self, key, fetch):
+        """Return the directory of entry ``key``, filling it with ``fetch(path)`` on a miss.
+
+        The entry cannot be evicted until the next call of `get` or `release`.
+
         """
+        existed, lock_file = self._create(key, fetch)
+        self.release()
+        self._held_lock = lock_file
+        if existed:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.touch(key)
+        log.info('Checkpoint cache %s: %d hits, %d misses' %
+                 (self.root, self.hits, self.misses))
+        self.evict(keep=key)
+        return self.entry_path(key)
+
+    def release(self):
+        """Unpin the entry last returned by `get`, letting it be evicted."""
+        if self._held_lock is not None:
+            self._held_lock.close()
+            self._held_lock = None
+
+    def add(self, key, files):
+        """Add ``files`` as entry ``key``, hard linking them when possible."""
+        def fill(path):
+            for _f in files:
+                dest = os.path.join(path, os.path.basename(_f))
+                try:
+                    os.link(_f, dest)
+                except OSError:
+                    shutil.copy2(_f, dest)
+        _, lock_file = self._create(key, fill)
+        lock_file.close()
+        self.touch(key)
+        self.evict(keep=key)
+        return self.entry_path(key)
+
+    def touch(self, key):
+        """Mark entry ``key`` as recently used."""
         try:
-            if self._target:
-                self._target(*self._args, **self._kwargs)
-        except Exception as error:
-            self._coord.request_stop(error)
+            os.utime(self.entry_path(key), None)
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits its budget.
+
+        Entries being created, restored or evicted by another process are skipped.
+
+        """
+        if self.max_bytes is None:
+            return
+        lock_file = self._lock('evict', blocking=False)
+        if lock_file is None:  # another process is evicting
+            return
+        try:
+            entries = []
+            for key in os.listdir(self.root):
+                path = self.entry_path(key)
+                if key.startswith('.') or not os.path.isdir(path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, _f))
+                           for _f in os.listdir(path))
+                entries.append((os.path.getmtime(path), key, size))
+            total = sum(size for _, _, size in entries)
+            for _, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                key_lock = self._lock(key, blocking=False)
+                if key_lock is None:
+                    continue
+                try:
+                    log.info('Evicting %s from checkpoint cache' % key)
+                    shutil.rmtree(self.entry_path(key), ignore_errors=True)
+                    os.remove(key_lock.name)
+                    total -= size
+                finally:
+                    key_lock.close()
         finally:
-            # Avoid a refcycle if the thread is running a function with
-            # an argument that has a member that points to the thread.
-            del self._target, self._args, self._kwargs
+            lock_file.close()
@@ -2,9 +2,11 @@
 All default values used in tfutils
 """
 
-from tfutils.utils import frozendict
+import numpy as np
 import tensorflow as tf
 
+from tfutils.utils import frozendict
+
 BRANCH_QUEUE_NAME = 'master_w_queue'
 
 DEFAULT_HOST = '/cpu:0'
@@ -16,12 +18,19 @@ DEFAULT_DONT_RUN = False
 DEFAULT_SKIP_CHECK = False
 DEFAULT_LOG_DEVICE_PLACEMENT = False
 DEFAULT_TRAIN_THRES_LOSS = 100
+# Seconds between two checks for new checkpoints by the async validation process
+DEFAULT_ASYNC_VALIDATION_POLL_SECS = 30
+# Train targets fetched on every step when train_params['every_step_targets'] is set
+DEFAULT_TRAIN_STEP_TARGETS = ('__grads__', 'optimizer', 'loss')
 
 DEFAULT_LOAD_PARAMS = frozendict(
         {'do_restore': True, 
          'from_ckpt': None, 
          'to_restore': None, 
-         'load_param_dict': None})
+         'load_param_dict': None,
+         'stream_restore': True,
+         'checkpoint_cache_dir': None,
+         'checkpoint_cache_bytes': 20 * 1024 ** 3})
 
 DEFAULT_LEARNING_RATE_PARAMS = frozendict({'func': tf.train.exponential_decay})
 
@@ -41,6 +50,20 @@ DEFAULT_SAVE_PARAMS = frozendict({'save_metrics_freq': 100,
                                   'save_filters_freq': 30000,
                                   'save_initial_filters': True,
                                   'save_to_gfs': (),
+                                  'save_to_gfs_format': 'pickle',
+                                  'gfs_array_threshold': None,
+                                  'train_results_format': 'list',
+                                  'stream_upload': True,
+                                  'save_queue_size': 16,
+                                  'metrics_buffer_size': 1,
+                                  'metrics_buffer_secs': 60,
+                                  'dedup_params': False,
+                                  'ensure_indexes': True,
+                                  'backend': 'mongo',
+                                  'delta_recent': False,
+                                  'snapshot_save': False,
+                                  'compression': None,
+                                  'compression_level': None,
                                   'do_save': True})
 
 DEFAULT_PARAMS = frozendict({
@@ -58,11 +81,37 @@ DEFAULT_PARAMS = frozendict({
 })
 
 
-def train_loop(sess, train_targets, num_minibatches=1, **loop_params):
+def _train_callable(sess, train_targets, kind):
+    """Return the cached ``sess.make_callable`` of a run of `train_loop`.
+
+    ``kind`` is 'grads' (gradient accumulation of a minibatch), 'step' (an
+    optimization step fetching only the loss) or 'all' (all train targets).
+    The callables are cached on the session (they hold a reference to it),
+    along with ``train_targets``, so that its id is not reused.
+
+    """
+    if not hasattr(sess, '_tfutils_train_callables'):
+        sess._tfutils_train_callables = {}
+    callables = sess._tfutils_train_callables
+    key = (kind, id(train_targets))
+    if key in callables and callables[key][0] is train_targets:
+        return callables[key][1]
+    if kind == 'grads':
+        fetches = [target['__grads__'] for target in train_targets]
+    elif kind == 'step':
+        fetches = [{_k: target[_k] for _k in ['__grads__', 'optimizer', 'loss']}
+                   for target in train_targets]
+    else:
+        fetches = train_targets
+    callables[key] = (train_targets, sess.make_callable(fetches))
+    return callables[key][1]
+
+
+def train_loop(sess, train_targets, num_minibatches=1, steps_per_run=1, **loop_params):
     """Define default minibatch training loop.
 
     A training loop that performs minibatching with ``num_minibatches``
-    minibatches.
+    minibatches, for ``steps_per_run`` optimization steps.
 
     Args:
         sess (tf.Session): Current tensorflow session.
@@ -70,23 +119,38 @@ def train_loop(sess, train_targets, num_minibatches=1, **loop_params):
             By default, ``base.train_from_params`` inserts the following
             targets to facilitate minibatching:
             * ``__grads__`` (tf.Operation): Accumulates and stores gradients.
-            * ``optimizer`` (tf.Operation): Applies and zeros gradients.
+            * ``optimizer`` (tf.Tensor): Applies and zeros gradients, and
+              evaluates to the global step after the update.
         num_minibatches (int): number of minibatches to use.
+        steps_per_run (int): number of optimization steps to run. All but the
+            last step only fetch the loss.
         **loop_params (mapping): additional, user-defined kwargs to
             be used in the training loop.
 
     Returns:
-        dict: A dictionary containing train targets evaluated by the session.
+        dict: A dictionary containing train targets evaluated by the session,
+            with the ``loss`` averaged over the ``steps_per_run`` steps.
 
     """
     assert all([required in targets for targets in train_targets
                 for required in ['__grads__', 'optimizer']])
 
-    # Perform minibatching
     range_len = (int)(num_minibatches)
-    for minibatch in range(range_len - 1):
-        # Accumulate gradient for each minibatch
-        sess.run([target['__grads__'] for target in train_targets])
-
-    # Compute final targets (includes zeroing gradient accumulator variable)
-    return sess.run(train_targets)
+    losses = []
+    for step in range(int(steps_per_run)):
+        # Perform minibatching
+        for minibatch in range(range_len - 1):
+            # Accumulate gradient for each minibatch
+            _train_callable(sess, train_targets, 'grads')()
+
+        # Compute final targets (includes zeroing gradient accumulator variable)
+        if step < steps_per_run - 1:
+            results = _train_callable(sess, train_targets, 'step')()
+        else:
+            results = _train_callable(sess, train_targets, 'all')()
+        losses.append([res['loss'] for res in results])
+
+    if steps_per_run > 1:
+        for res, model_losses in zip(results, zip(*losses)):
+            res['loss'] = np.mean(model_losses)
+    return results
@@ -5,7 +5,8 @@ import logging
 import tensorflow as tf
 import copy
 import numpy as np
-from tfutils.optimizer import ClipOptimizer, MinibatchOptimizer
+from tfutils.optimizer import ClipOptimizer, MinibatchOptimizer, \
+        pack_gradients, unpack_gradients
 import tfutils.utils as utils
 from tfutils.utils import aggregate_outputs
 import pdb
@@ -64,9 +65,12 @@ def get_model(inputs, model_params, param=None, trarg=None):
         devices = model_params['devices']
         num_gpus = model_params['num_gpus']
         multi_gpu_inputs = split_input(inputs, num_gpus)
+        graph_minibatches = 1
         # DEFAULT: Prepare loss and optimizer if training.
         if model_params['train']:
             assert param and trarg is not None
+            if param['train_params'].get('minibatch_mode') == 'graph':
+                graph_minibatches = int(trarg['num_minibatches'])
 
             tower_losses = []
             tower_grads = []
@@ -82,6 +86,15 @@ def get_model(inputs, model_params, param=None, trarg=None):
         for device, each_input in zip(devices, multi_gpu_inputs):
             with tf.device(device), tf.name_scope('__GPU__' + device[-1]):
 
+                if model_params['train'] and graph_minibatches > 1:
+                    model_params, output, loss, grad = get_minibatch_model(
+                            each_input, model_params, param,
+                            optimizer_base, graph_minibatches)
+                    tower_outputs.append(output)
+                    tower_losses.append(loss)
+                    tower_grads.append(grad)
+                    continue
+
                 model_params, output = get_model_base(each_input, **model_params)
                 tower_outputs.append(output)
 
@@ -115,14 +128,28 @@ def get_model(inputs, model_params, param=None, trarg=None):
         loss = tf.reduce_mean(tf.stack(tower_losses))
 
         # Aggregate and accumulate gradients.
-        minibatch_grads = optimizer_base.aggregate_gradients(tower_grads)
-        mini_flag, grads = optimizer_base.accumulate_gradients(
-                minibatch_grads, 
-                trarg['num_minibatches'])
+        minibatch_grads = optimizer_base.aggregate_gradients(
+                tower_grads,
+                optimizer_base.aggregate_method,
+                optimizer_base.bucket_size)
+        if param['train_params'].get('minibatch_mode') == 'graph':
+            # Already accumulated over the minibatches, one run per batch
+            grads = [(each_grad, var) for each_grad, var in minibatch_grads
+                     if each_grad is not None]
+            mini_flag = tf.no_op(name='__grads__')
+            trarg['num_minibatches'] = 1
+        else:
+            mini_flag, grads = optimizer_base.accumulate_gradients(
+                    minibatch_grads, 
+                    trarg['num_minibatches'])
         #grads = minibatch_grads
 
         # Apply accumulated gradients.
         optimizer = optimizer_base.apply_gradients(grads, trarg['global_step'])
+        # Evaluates to the step after the update, so train() needs no extra
+        # run to read it
+        with tf.control_dependencies([optimizer]):
+            optimizer = tf.identity(trarg['global_step'].read_value(), name='optimizer')
 
         # Prepare train_targets
         if 'loss' not in trarg['train_targets']:
@@ -134,6 +161,10 @@ def get_model(inputs, model_params, param=None, trarg=None):
             trarg['train_targets']['optimizer'] = optimizer
         if 'learning_rate' not in trarg['train_targets']:
             trarg['train_targets']['learning_rate'] = learning_rate
+        if optimizer_base.global_norms and 'global_norm' not in trarg['train_targets']:
+            # Averaged over the devices (and minibatches in the graph)
+            trarg['train_targets']['global_norm'] = tf.reduce_mean(
+                    tf.stack(optimizer_base.global_norms))
 
         param['model_params'] = model_params
         return param['model_params'], output, param, trarg
@@ -141,6 +172,52 @@ def get_model(inputs, model_params, param=None, trarg=None):
         return model_params, output
 
 
+def get_minibatch_model(inputs, model_params, param, optimizer_base, num_minibatches):
+    """Build the model, loss and gradients of a batch in `num_minibatches` parts.
+
+    The minibatches are built one after the other in the graph: each one
+    waits for the gradients of the previous one, which are summed into flat
+    buffers (see `optimizer.pack_gradients`), so that a single run computes
+    the average gradient of the whole batch within the memory of a minibatch.
+
+    Returns:
+        tuple: The model params, the outputs concatenated over the
+        minibatches, the mean loss and the averaged (grad, var) pairs.
+
+    """
+    outputs = []
+    losses = []
+    buffers = None
+    for each_input in split_input(inputs, num_minibatches):
+        if buffers is not None:
+            with tf.control_dependencies(buffers):
+                each_input = {key: tf.identity(value)
+                              for key, value in each_input.items()}
+
+        model_params, output = get_model_base(each_input, **model_params)
+        tf.get_variable_scope().reuse_variables()
+        param['loss_params'], loss = get_loss(
+                each_input, output,
+                **param['loss_params'])
+        tf.get_variable_scope().reuse_variables()
+        grad = optimizer_base.compute_gradients(loss)
+
+        minibatch_buffers, layout = pack_gradients(grad)
+        if buffers is None:
+            buffers = minibatch_buffers
+        else:
+            buffers = [tf.add(buffer, minibatch_buffer)
+                       for buffer, minibatch_buffer in zip(buffers, minibatch_buffers)]
+        outputs.append(output)
+        losses.append(loss)
+
+    buffers = [tf.divide(buffer, tf.cast(num_minibatches, buffer.dtype))
+               for buffer in buffers]
+    grad = unpack_gradients(buffers, layout, grad)
+    return model_params, aggregate_outputs(outputs), \
+            tf.reduce_mean(tf.stack(losses)), grad
+
+
 def get_learning_rate(global_step,
                       func=tf.train.exponential_decay,
                       **learning_rate_params):
@@ -366,6 +443,16 @@ def parse_params(mode,
                     param['train_loop'] = {'func': train_loop}
                     log.info('train_loop not specified for model {}... '.format(model_num) +
                              'Using default training loop.')
+                if 'steps_per_run' not in param:
+                    param['steps_per_run'] = 1
+                if 'every_step_targets' not in param:
+                    param['every_step_targets'] = None
+                if 'async_validation' not in param:
+                    param['async_validation'] = False
+                if 'minibatch_mode' not in param:
+                    param['minibatch_mode'] = 'session'
+                assert param['minibatch_mode'] in ['session', 'graph'], \
+                        "Unsupported minibatch_mode: %s" % param['minibatch_mode']
                 if 'validate_first' not in param:
                     param['validate_first'] = True
                     log.info('validate_fist not specified for model {}... '.format(model_num) +
@@ -400,7 +487,14 @@ def parse_params(mode,
                                  .format(minibatch_size))
                     param['minibatch_size'] = minibatch_size
                     param['num_minibatches'] = num_minibatches
-                    param['data_params']['batch_size'] = minibatch_size
+                    if param['minibatch_mode'] == 'graph':
+                        # The batch is split into minibatches in the graph
+                        assert num_minibatches == int(num_minibatches) and \
+                                batch_size % num_minibatches == 0, (
+                                'In graph minibatch_mode, the number of minibatches '
+                                'must divide the batch size.')
+                    else:
+                        param['data_params']['batch_size'] = minibatch_size
 
         params[name] = param_list
 
@@ -441,7 +535,9 @@ def parse_params(mode,
             'thres_loss': [p['thres_loss'] for p in params['train_params']],
             'train_loop': [p['train_loop']['func'] for p in params['train_params']],
             'validate_first': [p['validate_first'] for p in params['train_params']],
-            'num_minibatches': [p['num_minibatches'] for p in params['train_params']]})
+            'num_minibatches': [p['num_minibatches'] for p in params['train_params']],
+            'steps_per_run': [p['steps_per_run'] for p in params['train_params']],
+            'every_step_targets': [p['every_step_targets'] for p in params['train_params']]})
 
     return params, run_args
 
@@ -0,0 +1,56 @@
+"""Modules whose attributes are imported on first access.
+
+Used by the package surface (``tfutils/__init__.py``, ``tfutils/model.py``)
+so that ``import tfutils`` does not pull in TensorFlow, pymongo or git
+before they are needed.
+
+"""
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """Module importing its lazy attributes when they are first accessed.
+
+    Args:
+        name (str): Name of the module.
+        attributes (dict): Maps attribute names to ``(module name, attribute
+            name)``, or to ``(module name, None)`` for the module itself.
+
+    """
+
+    def __init__(self, name, attributes, doc=None):
+        super(LazyModule, self).__init__(name, doc)
+        self._lazy_attributes = attributes
+
+    def __getattr__(self, name):
+        # only called when ``name`` is not (yet) set on the module
+        if name.startswith('__') or name not in self._lazy_attributes:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        module_name, attr = self._lazy_attributes[name]
+        value = importlib.import_module(module_name)
+        if attr is not None:
+            value = getattr(value, attr)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._lazy_attributes))
+
+
+def make_lazy(name, attributes):
+    """Replace the module ``name`` in ``sys.modules`` by a `LazyModule`.
+
+    Call it at the end of the module; the attributes already defined are
+    kept, those in ``attributes`` are imported on first access.
+
+    """
+    module = sys.modules[name]
+    lazy = LazyModule(name, attributes, module.__doc__)
+    lazy.__dict__.update(module.__dict__)
+    # python 2 clears the globals of a module when it is deleted
+    lazy._module = module
+    lazy.__all__ = sorted(attributes)
+    sys.modules[name] = lazy
+    return lazy
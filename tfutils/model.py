@@ -1,17 +1,25 @@
 """Entrance of model building tools.
 
-IMPORTANT thing to know: 
+IMPORTANT thing to know:
 Tfutils **does NOT** require the usage of these tools at all!
 We put these tools here just to be used in:
 tutorials, function tests, and for users who previously used these tools
 
+The tools are imported when first used, so importing this module does not
+load both of them.
+
 """
+from tfutils.lazy import make_lazy
 
-# Model building tool used in tutorials and function tests
-from model_tool import ConvNet as ConvNet_new
-from model_tool import mnist_tfutils as mnist_tfutils_new
-from model_tool import alexnet_tfutils as alexnet_tfutils_new
+make_lazy(__name__, {
+    # Model building tool used in tutorials and function tests
+    'ConvNet_new': ('tfutils.model_tool', 'ConvNet'),
+    'mnist_tfutils_new': ('tfutils.model_tool', 'mnist_tfutils'),
+    'alexnet_tfutils_new': ('tfutils.model_tool', 'alexnet_tfutils'),
 
-# Model building tool used for previous users
-# This tool is too complicated to understand and no longer recommended at all!
-from model_tool_old import ConvNet, mnist_tfutils, alexnet_tfutils
+    # Model building tool used for previous users
+    # This tool is too complicated to understand and no longer recommended at all!
+    'ConvNet': ('tfutils.model_tool_old', 'ConvNet'),
+    'mnist_tfutils': ('tfutils.model_tool_old', 'mnist_tfutils'),
+    'alexnet_tfutils': ('tfutils.model_tool_old', 'alexnet_tfutils'),
+})
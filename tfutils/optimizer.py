@@ -4,6 +4,8 @@ The ClipOptimizer class adds support for gradient clipping, gradient
 aggregation across devices and gradient accumulation useful for
 performing minibatching (accumulating and aggregating
 gradients for multiple batches before applying a gradient update).
+`pack_gradients` and `unpack_gradients` move gradients to and from flat
+buffers, to process all of them with a few ops.
 
 """
 import os
@@ -21,6 +23,68 @@ else:
 log = logging.getLogger('tfutils')
 log.setLevel('DEBUG')
 
+DEFAULT_BUCKET_SIZE = 4 * 1024 * 1024
+
+
+def pack_gradients(grads_and_vars, bucket_size=None):
+    """Concatenate the gradients in `grads_and_vars` into flat buffers.
+
+    The gradients are flattened and concatenated into one 1-D buffer per
+    dtype, so that they can be accumulated or aggregated with a single op
+    instead of one op per variable. With `bucket_size`, a new buffer is
+    started once a buffer would hold more than `bucket_size` elements.
+
+    Returns:
+        (list, list): The buffers, and the layout to pass to
+        `unpack_gradients`, with one ``(buffer index, size, shape)`` entry per
+        item of `grads_and_vars` (None where the gradient is None).
+
+    """
+    parts = []
+    sizes = []
+    open_buffers = {}
+    layout = []
+    flat_shape = tf.constant([-1])
+    for grad, var in grads_and_vars:
+        if grad is None:
+            layout.append(None)
+            continue
+        grad = tf.convert_to_tensor(grad)
+        shape = var.shape if var.shape.is_fully_defined() else grad.shape
+        size = shape.num_elements()
+        index = open_buffers.get(grad.dtype)
+        if index is None or (bucket_size and sizes[index]
+                             and sizes[index] + size > bucket_size):
+            index = open_buffers[grad.dtype] = len(parts)
+            parts.append([])
+            sizes.append(0)
+        parts[index].append(tf.reshape(grad, flat_shape))
+        sizes[index] += size
+        layout.append((index, size, shape))
+    buffers = [tf.concat(each_parts, axis=0) if len(each_parts) > 1 else each_parts[0]
+               for each_parts in parts]
+    return buffers, layout
+
+
+def unpack_gradients(buffers, layout, grads_and_vars):
+    """Split the buffers of `pack_gradients` back into (grad, var) pairs."""
+    sizes = [[] for _ in buffers]
+    for entry in layout:
+        if entry is not None:
+            sizes[entry[0]].append(entry[1])
+    splits = [tf.split(buffer, each_sizes) if len(each_sizes) > 1 else [buffer]
+              for buffer, each_sizes in zip(buffers, sizes)]
+    positions = [0 for _ in buffers]
+    unpacked = []
+    for entry, (grad, var) in zip(layout, grads_and_vars):
+        if entry is None:
+            unpacked.append((None, var))
+            continue
+        index, _, shape = entry
+        unpacked.append((tf.reshape(splits[index][positions[index]], shape), var))
+        positions[index] += 1
+    return unpacked
+
 
 class ClipOptimizer(object):
     """A wrapper for general optimizers. 
@@ -34,9 +98,16 @@ class ClipOptimizer(object):
         optimizer_class: Returned value of this function should have `compute_gradients` and `apply_gradients` methods.
         clip (bool, optional): Default is True, clipping by `[-1, 1]`.
         trainable_names (list of strings, or string, optional): Default is None. Scope names for variables to avoid training.
+        clip_method (str, optional): Default is 'value', clipping each gradient element.
+            'global_norm' rescales all gradients together so that their global norm is at most `clip_norm`.
+        clip_norm (float, optional): Default is 1. The largest global norm with 'global_norm'.
+        fused (bool, optional): Default is False. With 'global_norm', compute the norm and rescale
+            over the flat buffers of `pack_gradients`, with a few ops instead of a few per variable.
 
     """
-    def __init__(self, optimizer_class, clip=True, trainable_names=None, *optimizer_args, **optimizer_kwargs):
+    def __init__(self, optimizer_class, clip=True, trainable_names=None,
+                 clip_method='value', clip_norm=1., fused=False,
+                 *optimizer_args, **optimizer_kwargs):
         self._optimizer = optimizer_class(*optimizer_args, **optimizer_kwargs)
         # The optimizer needs to have these required methods
         required_methods = ['compute_gradients', 'apply_gradients']
@@ -44,7 +115,14 @@ class ClipOptimizer(object):
             assert required_method in dir(self._optimizer), \
                     "Your optimizer needs to have method %s!" % required_method
 
+        if clip_method not in ('value', 'global_norm'):
+            raise ValueError('Unsupported clipping method: {}.'.format(clip_method))
         self.clip = clip
+        self.clip_method = clip_method
+        self.clip_norm = clip_norm
+        self.fused = fused
+        # The global norm of the gradients of each compute_gradients call
+        self.global_norms = []
         self.var_list = None
         if not isinstance(trainable_names, list) and trainable_names is not None:
             trainable_names = [trainable_names]
@@ -58,7 +136,8 @@ class ClipOptimizer(object):
 
         Returns:
             (tf.Operation): Compute gradient update to model followed by a
-            clipping operation if `self.clip` is True.
+            clipping operation if `self.clip` is True. With 'global_norm',
+            the norm before clipping is appended to `self.global_norms`.
 
         """
         train_vars = None
@@ -80,10 +159,30 @@ class ClipOptimizer(object):
         if self.clip:
             # gradient clipping. Some gradients returned are 'None' because
             # no relation between the variable and loss; so we skip those.
-            gvs = [(tf.clip_by_value(grad, -1., 1.), var)
-                   for grad, var in gvs if grad is not None]
+            gvs = [(grad, var) for grad, var in gvs if grad is not None]
+            if self.clip_method == 'global_norm':
+                gvs = self.clip_by_global_norm(gvs)
+            else:
+                gvs = [(tf.clip_by_value(grad, -1., 1.), var)
+                       for grad, var in gvs]
         return gvs
 
+    def clip_by_global_norm(self, grads_and_vars):
+        """Rescale `grads_and_vars` to a global norm of at most `self.clip_norm`."""
+        if self.fused:
+            buffers, layout = pack_gradients(grads_and_vars)
+            global_norm = tf.global_norm(buffers, name='global_norm')
+            buffers, _ = tf.clip_by_global_norm(buffers, self.clip_norm,
+                                                use_norm=global_norm)
+            grads_and_vars = unpack_gradients(buffers, layout, grads_and_vars)
+        else:
+            grads, global_norm = tf.clip_by_global_norm(
+                    [grad for grad, _ in grads_and_vars], self.clip_norm)
+            grads_and_vars = [(grad, var) for grad, (_, var)
+                              in zip(grads, grads_and_vars)]
+        self.global_norms.append(global_norm)
+        return grads_and_vars
+
     def apply_gradients(self, grads_and_vars, global_step=None):
         """Apply gradients to model variables specified in `grads_and_vars`.
 
@@ -110,10 +209,16 @@ class MinibatchOptimizer(object):
     This class supports:
 
     - Minibatch, only apply gradients after several steps. By default, apply gradients after each step
+    - Aggregating the gradients of several devices. By default, averaging them per variable,
+      with aggregate_method 'fused' through flat buffers of at most bucket_size elements
+      (default: 4M, buckets are faster to concatenate and sum than one buffer of a whole net)
     """
 
-    def __init__(self, optimizer, *optimizer_args, **optimizer_kwargs):
+    def __init__(self, optimizer, aggregate_method='average', bucket_size=DEFAULT_BUCKET_SIZE,
+                 *optimizer_args, **optimizer_kwargs):
         self._optimizer = optimizer(*optimizer_args, **optimizer_kwargs)
+        self.aggregate_method = aggregate_method
+        self.bucket_size = bucket_size
         # The optimizer needs to have these required methods
         required_methods = ['compute_gradients', 'apply_gradients']
         for required_method in required_methods:
@@ -124,6 +229,11 @@ class MinibatchOptimizer(object):
         self.mini_flag = tf.Variable(tf.zeros(1), trainable=False)
         #self.var_list = None
 
+    @property
+    def global_norms(self):
+        """The gradient norms computed by the wrapped optimizer, if it clips by global norm."""
+        return getattr(self._optimizer, 'global_norms', [])
+
     def compute_gradients(self, loss, *args, **kwargs):
         gvs = self._optimizer.compute_gradients(
                 loss,
@@ -133,9 +243,11 @@ class MinibatchOptimizer(object):
         return gvs
 
     @classmethod
-    def aggregate_gradients(cls, grads_and_vars, method='average'):
+    def aggregate_gradients(cls, grads_and_vars, method='average', bucket_size=None):
         if method == 'average':
             return cls.average_gradients(grads_and_vars)
+        elif method == 'fused':
+            return cls.fused_average_gradients(grads_and_vars, bucket_size)
         else:
             raise ValueError('Unsupported aggregation method: {}.'.format(method))
 
@@ -159,6 +271,25 @@ class MinibatchOptimizer(object):
             average_grads.append(grad_and_var)
         return average_grads
 
+    @classmethod
+    def fused_average_gradients(cls, tower_grads, bucket_size=None):
+        """Average a list of (grads, vars) through flat buffers.
+
+        The gradients of each tower are packed into flat buffers (see
+        `pack_gradients`), which are averaged with one `add_n` each and split
+        back, instead of building ops per variable and tower.
+
+        """
+        if len(tower_grads) == 1:
+            return tower_grads[0]
+        packed = [pack_gradients(grads_and_vars, bucket_size)
+                  for grads_and_vars in tower_grads]
+        scale = 1. / len(tower_grads)
+        buffers = [tf.add_n(list(tower_buffers)) * tf.cast(scale, tower_buffers[0].dtype)
+                   for tower_buffers in zip(*[each_buffers for each_buffers, _ in packed])]
+        # all variables are the same so we just use the first gpu variables
+        return unpack_gradients(buffers, packed[0][1], tower_grads[0])
+
     def accumulate_gradients(self, minibatch_grads, num_minibatches=1):
         """Accumulate gradients for `num_minibatches` minibatches."""
 
@@ -47,7 +47,7 @@ def test(sess,
 
     res = []
     for ttarg in _ttargs:
-        ttarg['dbinterface'].sync_with_host()
+        ttarg['dbinterface'].close()
         res.append(ttarg['dbinterface'].outrecs)
 
     return validation_summary, res
@@ -11,6 +11,7 @@ import unittest
 from collections import defaultdict
 import copy
 
+import numpy as np
 import gridfs
 import pymongo
 import tensorflow as tf
@@ -22,6 +23,7 @@ sys.path.insert(0, "..")
 
 import tfutils.base as base
 import tfutils.model as model
+import tfutils.optimizer as optimizer
 import tfutils.utils as utils
 from tfutils.db_interface import TFUTILS_HOME
 
@@ -158,6 +160,10 @@ class TestBase(unittest.TestCase):
         self.asserts_for_record(r, params, train=True)
         r = self.collection['files'].find({'exp_id': exp_id, 'step': 20})[0]
         self.asserts_for_record(r, params, train=True)
+        # the step returned by the optimizer target is not saved
+        self.assertEqual(len(r['train_results']), 20)
+        for train_res in r['train_results']:
+            self.assertNotIn('optimizer', train_res)
 
         # Run another 500 steps of training on the same experiment id.
         params['train_params']['num_steps'] = 1000
@@ -195,6 +201,82 @@ class TestBase(unittest.TestCase):
 
         base.train_from_params(**params)
 
+    def test_graph_minibatch_training(self):
+        """Illustrate training with the minibatches accumulated in the graph."""
+        exp_id = 'training_graph_minibatch'
+        params = self.setup_params(exp_id)
+        params['train_params']['minibatch_size'] = 25
+        params['train_params']['minibatch_mode'] = 'graph'
+
+        train_args = base.train_from_params(dont_run=True, **params)
+        # The whole batch is read and trained on in one run
+        self.assertEqual(train_args['num_minibatches'], [1])
+        self.assertEqual(params['train_params']['data_params']['batch_size'], 100)
+
+        base.train_from_params(**params)
+        self.assert_as_expected(exp_id, count=26, step=[0, 200, 400])
+
+    def test_fused_aggregation(self):
+        """Check the fused averaging of tower gradients against the per-variable one."""
+        with tf.Graph().as_default():
+            variables = [tf.Variable(tf.zeros([3, 4])), tf.Variable(tf.zeros([5])),
+                         tf.Variable(tf.zeros([2, 2]))]
+            tower_grads = [[(tf.random_normal(var.shape), var) for var in variables]
+                           for _ in range(3)]
+            # No gradient for the second variable
+            for each_grads in tower_grads:
+                each_grads[1] = (None, variables[1])
+            average = optimizer.MinibatchOptimizer.aggregate_gradients(tower_grads)
+            fused = optimizer.MinibatchOptimizer.aggregate_gradients(
+                    tower_grads, method='fused', bucket_size=10)
+            self.assertIsNone(fused[1][0])
+            self.assertEqual([var for _, var in fused], variables)
+            with tf.Session() as sess:
+                average, fused = sess.run([[average[0][0], average[2][0]],
+                                           [fused[0][0], fused[2][0]]])
+            for average_grad, fused_grad in zip(average, fused):
+                self.assertTrue(np.allclose(average_grad, fused_grad))
+
+    def test_global_norm_clipping(self):
+        """Check the fused global norm clipping against the per-variable one."""
+        with tf.Graph().as_default():
+            variables = [tf.Variable(tf.zeros([3, 4])), tf.Variable(tf.zeros([5]))]
+            loss = tf.add_n([10 * tf.reduce_sum(tf.square(var - 1)) for var in variables])
+            results = []
+            for fused in [False, True]:
+                clip_optimizer = optimizer.ClipOptimizer(
+                        tf.train.GradientDescentOptimizer, clip_method='global_norm',
+                        clip_norm=2., fused=fused, learning_rate=1.)
+                grads = clip_optimizer.compute_gradients(loss)
+                self.assertEqual(len(clip_optimizer.global_norms), 1)
+                results.append([clip_optimizer.global_norms[0]] + [grad for grad, _ in grads])
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                results = sess.run(results)
+        # Each of the 17 gradient elements is -20
+        self.assertAlmostEqual(results[0][0], 20 * np.sqrt(17), places=3)
+        self.assertAlmostEqual(np.sqrt(sum(np.sum(np.square(grad)) for grad in results[1][1:])),
+                               2., places=4)
+        for grad, fused_grad in zip(results[0], results[1]):
+            self.assertTrue(np.allclose(grad, fused_grad))
+
+    def test_async_validation(self):
+        """Illustrate validating the checkpoints in a separate process."""
+        exp_id = 'training_async_validation'
+        params = self.setup_params(exp_id)
+        params['train_params']['async_validation'] = True
+
+        base.train_from_params(**params)
+
+        # The last checkpoint is always validated, possibly not the earlier ones
+        coll = self.collection['files']
+        valid_recs = list(coll.find({'exp_id': exp_id, 'validates': {'$exists': True}}))
+        self.assertIn(500, [r['step'] for r in valid_recs])
+        for r in valid_recs:
+            self.assertEqual(r['step'] % 100, 0)
+            self.assertItemsEqual(r['validation_results'].keys(),
+                                  params['validation_params'].keys())
+
     def test_training_save(self):
         """Illustrate saving to the grid file system during training time."""
         exp_id = 'training_save'
@@ -230,6 +312,32 @@ class TestBase(unittest.TestCase):
         self.assertEqual(len(saved_data['train_results']['first_image']), 100)
         self.assertEqual(saved_data['train_results']['first_image'][0].shape, (28 * 28,))
 
+    def test_training_save_step_targets(self):
+        """Illustrate fetching the saved train targets only on save steps."""
+        exp_id = 'training_save_step_targets'
+        params = self.setup_params(exp_id)
+        params['save_params']['save_valid_freq'] = 3000
+        params['save_params']['save_filters_freq'] = 30000
+        params['save_params']['cache_filters_freq'] = 3000
+        params['save_params']['save_to_gfs'] = ['first_image']
+        params['train_params']['targets'] = {'func': self.get_first_image_target}
+        params['train_params']['every_step_targets'] = ['learning_rate']
+
+        base.train_from_params(**params)
+
+        coll = self.collection['files']
+        r = coll.find({'exp_id': exp_id, 'step': 200})[0]
+        self.assertEqual(len(r['train_results']), 100)
+        for train_res in r['train_results']:
+            self.assertIn('learning_rate', train_res)
+        fn = coll.find({'item_for': r['_id']})[0]['filename']
+        fs = gridfs.GridFS(coll.database, self.collection_name)
+        fh = fs.get_last_version(fn)
+        saved_data = cPickle.loads(fh.read())
+        fh.close()
+        # Only fetched for the step of the record
+        self.assertEqual(len(saved_data['train_results']['first_image']), 1)
+
     def test_validation(self):
         """Illustrate validation.
 
@@ -2,14 +2,20 @@
 
 import os
 import re
+import imp
 import sys
 import time
 import errno
 import shutil
+import select
+import signal
 import logging
+import tempfile
+import cStringIO
 import pymongo
 import unittest
 
+import numpy as np
 import tensorflow as tf
 import mnist_data as data
 
@@ -20,6 +26,16 @@ import tfutils.model as model
 import tfutils.optimizer as optimizer
 from tfutils.db_interface import TFUTILS_HOME
 from tfutils.db_interface import DBInterface
+from tfutils.db_interface import params_hash, sonify, step_is_due
+import tfutils.db_interface as db_interface
+from tfutils.backends import LocalBackend
+from tfutils.db_interface import put_tar_stream, extract_tar_stream, \
+        has_pb2_v2_files, CheckpointWriter, CheckpointCache
+from tfutils.db_interface import read_checkpoint, write_checkpoint, \
+        checkpoint_digests, write_delta_checkpoint, merge_delta_checkpoint, \
+        ArrayCheckpointWriter, put_file, open_file
+from tfutils.db_interface import put_gfs_items, find_gfs_items, load_gfs_item, \
+        load_gfs_features, TrainResultsBuffer, load_train_results
 
 
 # def logPoint(context):
@@ -101,6 +117,14 @@ class TestDBInterface(unittest.TestCase):
         # TODO: Test all permutations of __init__ params.
         pass
 
+    def test_shared_client(self):
+        other = DBInterface(params=self.params,
+                            cache_dir=self.CACHE_DIR,
+                            save_params=self.save_params,
+                            load_params=self.load_params)
+        self.assertIs(other.conn, self.dbinterface.conn)
+        self.assertIs(other.load_conn, self.dbinterface.conn)
+
     @unittest.skip("skipping")
     def test_load_rec(self):
         pass
@@ -374,5 +398,448 @@ class TestDBInterface(unittest.TestCase):
                 raise
 
 
+class TestCheckpointStreams(unittest.TestCase):
+    """Round-trip checkpoint files through the tar streaming helpers."""
+
+    class _GridIn(object):
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.buf = cStringIO.StringIO()
+            self._id = 'test_id'
+
+        def write(self, data):
+            self.buf.write(data)
+
+        def close(self):
+            pass
+
+        def abort(self):
+            raise AssertionError('Upload should not be aborted.')
+
+    class _GridFS(object):
+
+        def new_file(self, **kwargs):
+            self.grid_in = TestCheckpointStreams._GridIn(**kwargs)
+            return self.grid_in
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.dst_dir = tempfile.mkdtemp()
+        self.prefix = 'checkpoint-100'
+        self.files = []
+        for suffix, size in [('.index', 100), ('.data-00000-of-00001', 10000)]:
+            path = os.path.join(self.src_dir, self.prefix + suffix)
+            with open(path, 'wb') as _fp:
+                _fp.write(os.urandom(size))
+            self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.dst_dir)
+
+    def test_round_trip(self):
+        fs = self._GridFS()
+        outrec = put_tar_stream(fs, self.files, filename='ckpt.tar', step=100)
+        self.assertEqual(outrec, 'test_id')
+        self.assertEqual(fs.grid_in.kwargs, {'filename': 'ckpt.tar', 'step': 100})
+
+        fs.grid_in.buf.seek(0)
+        extract_tar_stream(fs.grid_in.buf, self.dst_dir)
+        self.assertEqual(sorted(os.listdir(self.dst_dir)),
+                         sorted(os.path.basename(f) for f in self.files))
+        for path in self.files:
+            with open(path, 'rb') as src, \
+                    open(os.path.join(self.dst_dir, os.path.basename(path)), 'rb') as dst:
+                self.assertEqual(src.read(), dst.read())
+        self.assertTrue(has_pb2_v2_files(os.path.join(self.dst_dir, self.prefix),
+                                         {'_saver_num_data_files': 1}))
+        self.assertFalse(has_pb2_v2_files(os.path.join(self.dst_dir, 'checkpoint-200'),
+                                          {'_saver_num_data_files': 1}))
+
+
+class TestCheckpointWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = CheckpointWriter(max_queue_size=2)
+        self.done = []
+
+    def tearDown(self):
+        self.writer.close()
+
+    def job(self, i):
+        time.sleep(0.01)
+        self.done.append(i)
+
+    def test_jobs_run_in_order(self):
+        for i in range(5):
+            self.writer.submit(self.job, args=(i,))
+        self.writer.join()
+        self.assertEqual(self.done, range(5))
+        stats = self.writer.stats()
+        self.assertEqual(stats['num_jobs'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreater(stats['max_latency'], 0)
+
+    def test_error_is_reraised(self):
+        def fail():
+            raise ValueError('save failed')
+        self.writer.submit(fail)
+        with self.assertRaises(ValueError):
+            self.writer.join()
+        # The writer keeps working after the error has been reported.
+        self.writer.submit(self.job, args=(0,))
+        self.writer.join()
+        self.assertEqual(self.done, [0])
+
+    def test_error_is_reraised_by_close(self):
+        def fail():
+            time.sleep(0.05)
+            raise ValueError('save failed')
+        writer = CheckpointWriter()
+        writer.submit(fail)
+        # dropped, since it is queued after the failed job
+        writer.submit(self.job, args=(0,))
+        with self.assertRaises(ValueError):
+            writer.close()
+        self.assertEqual(self.done, [])
+
+    def test_on_idle(self):
+        idle = []
+        writer = CheckpointWriter(on_idle=lambda: idle.append(len(self.done)),
+                                  idle_secs=0.01)
+        try:
+            writer.submit(self.job, args=(0,))
+            time.sleep(0.1)
+        finally:
+            writer.close()
+        self.assertGreater(len(idle), 1)
+        self.assertEqual(idle[-1], 1)
+
+
+class TestCheckpointCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = CheckpointCache(self.root, max_bytes=10)
+        self.fetched = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fetch(self, key):
+        def _fetch(path):
+            self.fetched.append(key)
+            with open(os.path.join(path, 'data'), 'w') as _fp:
+                _fp.write('x' * 4)
+        return _fetch
+
+    def test_hits_and_eviction(self):
+        for key in ['a', 'b', 'a', 'c']:
+            path = self.cache.get(key, self.fetch(key))
+            self.assertTrue(os.path.isfile(os.path.join(path, 'data')))
+            time.sleep(0.01)
+        self.assertEqual(self.fetched, ['a', 'b', 'c'])
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 3})
+        # 'b' is the least recently used entry
+        self.assertEqual(sorted(_k for _k in os.listdir(self.root)
+                                if not _k.startswith('.')), ['a', 'c'])
+
+    def test_handed_out_entry_is_kept(self):
+        # e.g. another process restoring from 'a'
+        other = CheckpointCache(self.root, max_bytes=10)
+        other.get('a', self.fetch('a'))
+        for key in ['b', 'c']:
+            time.sleep(0.01)
+            self.cache.get(key, self.fetch(key))
+        self.assertTrue(os.path.isdir(self.cache.entry_path('a')))
+        self.assertFalse(os.path.isdir(self.cache.entry_path('b')))
+
+    def test_concurrent_miss(self):
+        def slow_fetch(path):
+            time.sleep(1)
+            with open(os.path.join(path, 'data'), 'w') as _fp:
+                _fp.write('x' * 4)
+
+        def get(cache):
+            time.sleep(max(0, start - time.time()))
+            cache.get('a', slow_fetch)
+            return time.time() - start
+
+        # both processes miss 'a' at once, then keep it pinned for a while
+        start = time.time() + 0.2
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write_fd, '%f' % get(CheckpointCache(self.root)))
+                time.sleep(10)
+            finally:
+                os._exit(0)
+        try:
+            elapsed = get(self.cache)
+            ready, _, _ = select.select([read_fd], [], [], 5)
+            self.assertTrue(ready, 'the other process is still waiting')
+            other_elapsed = float(os.read(read_fd, 64))
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertEqual(sorted(self.cache.stats().values()), [0, 1])
+        self.assertLess(max(elapsed, other_elapsed), 3)
+
+    def test_failed_fetch(self):
+        def fail(path):
+            raise IOError('download failed')
+        with self.assertRaises(IOError):
+            self.cache.get('a', fail)
+        self.assertFalse(os.path.exists(self.cache.entry_path('a')))
+        self.cache.get('a', self.fetch('a'))
+        self.assertEqual(self.fetched, ['a'])
+
+
+class TestDeltaCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def test_round_trip(self):
+        base_vars = {'frozen/w': np.arange(6, dtype=np.float32).reshape(2, 3),
+                'head/b': np.zeros(3, dtype=np.float32),
+                'global_step': np.array(10, dtype=np.int64)}
+        base_path = write_checkpoint(base_vars, self.path('base'))
+        new = dict(base_vars, **{'head/b': np.ones(3, dtype=np.float32),
+                            'global_step': np.array(20, dtype=np.int64)})
+        new_path = write_checkpoint(new, self.path('new'))
+
+        delta_path, changed = write_delta_checkpoint(
+                new_path, checkpoint_digests(base_path), self.path('delta'))
+        self.assertEqual(changed, ['global_step', 'head/b'])
+        self.assertNotIn('frozen/w', read_checkpoint(delta_path))
+
+        merged = read_checkpoint(merge_delta_checkpoint(
+                base_path, delta_path, self.path('merged')))
+        self.assertEqual(sorted(merged), sorted(new))
+        for name in new:
+            np.testing.assert_array_equal(merged[name], new[name])
+
+
+class TestArrayCheckpointWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.writer = ArrayCheckpointWriter(
+                {'w': (tf.float32, tf.TensorShape([2, 2])),
+                 'global_step': (tf.int64, tf.TensorShape([]))})
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_saves_reuse_graph(self):
+        num_ops = len(self.writer.graph.get_operations())
+        for step in [100, 200]:
+            arrays = {'w': np.full((2, 2), step, dtype=np.float32),
+                      'global_step': np.array(step, dtype=np.int64)}
+            path = self.writer.save(arrays, os.path.join(self.tmp_dir, 'checkpoint'),
+                                    global_step=step)
+            self.assertTrue(path.endswith('checkpoint-%d' % step))
+            saved = read_checkpoint(path)
+            np.testing.assert_array_equal(saved['w'], arrays['w'])
+            self.assertEqual(saved['global_step'], step)
+        self.assertEqual(len(self.writer.graph.get_operations()), num_ops)
+
+
+class TestParamsHash(unittest.TestCase):
+
+    def test_hash_ignores_key_order(self):
+        a = {'model_params': {'seed': 0, 'func': 'f'}, 'exp_id': 'e'}
+        b = {'exp_id': 'e', 'model_params': {'func': 'f', 'seed': 0}}
+        self.assertEqual(params_hash(a), params_hash(b))
+        b['model_params']['seed'] = 1
+        self.assertNotEqual(params_hash(a), params_hash(b))
+
+
+class TestStepIsDue(unittest.TestCase):
+
+    def test_single_steps(self):
+        self.assertEqual([step for step in range(1, 50) if step_is_due(step, 20, step - 1)],
+                         [20, 40])
+        self.assertEqual([step for step in range(1, 50) if step_is_due(step, 20)],
+                         [20, 40])
+
+    def test_multiple_steps(self):
+        self.assertEqual([step for step in range(3, 70, 3) if step_is_due(step, 20, step - 3)],
+                         [21, 42, 60])
+
+
+class TestSonify(unittest.TestCase):
+
+    def test_memo(self):
+        shared = [1, 2.0, np.int64(3)]
+        rval = sonify({'a': shared, 'b': shared, 'f': params_hash}, skip=True)
+        self.assertEqual(rval['a'], [1, 2.0, 3])
+        self.assertIs(rval['a'], rval['b'])
+        self.assertEqual(rval['f'], {'objname': 'params_hash',
+                                     'modname': 'tfutils.db_interface'})
+
+    def test_arrays(self):
+        rval = sonify({'top1': np.array([True, False]),
+                       'loss': np.arange(4, dtype=np.float32).reshape(2, 2),
+                       'step': np.array(3),
+                       'names': np.array(['a', 'b'])})
+        self.assertEqual(rval, {'top1': [1, 0], 'loss': [[0.0, 1.0], [2.0, 3.0]],
+                                'step': 3, 'names': ['a', 'b']})
+        self.assertIs(type(rval['top1'][0]), int)
+        self.assertIs(type(rval['loss'][0][0]), float)
+
+    def test_version_info_is_cached(self):
+        src_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(src_dir, 'versioned_module.py')
+            with open(path, 'w') as _fp:
+                _fp.write('__version__ = "1.0"\n')
+            module = imp.load_source('versioned_module', path)
+            info = db_interface.version_check_and_info(module)
+            self.assertEqual(info['version'], '1.0')
+            self.assertIn('versioned_module', db_interface._MODULE_INFO_CACHE)
+            # callers get copies they can modify
+            info['version'] = None
+            module.__version__ = '2.0'
+            self.assertEqual(db_interface.version_check_and_info(module)['version'], '1.0')
+        finally:
+            shutil.rmtree(src_dir)
+
+
+class TestTrainResultsBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = LocalBackend(self.root, 'testdb', 'testcol', 'exp')
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def test_round_trip(self):
+        train_results = []
+        for step in range(1, 301):
+            train_res = {'loss': np.float32(step) / 2, 'learning_rate': 0.1}
+            if step % 100 == 0:
+                train_res['top1'] = step
+                train_res['names'] = ['a', 'b']
+            train_results.append(train_res)
+
+        buffer = TrainResultsBuffer(capacity=16)
+        for step, train_res in enumerate(train_results, 1):
+            buffer.append(step, train_res)
+        self.assertEqual(len(buffer), 300)
+        rec, to_gfs = buffer.to_record(gfs_array_threshold=1000)
+        self.assertEqual(sorted(to_gfs), ['learning_rate', 'loss'])
+        self.assertEqual(rec['summary']['loss']['max'], 150)
+        self.assertEqual(rec['summary']['top1']['mean'], 200)
+
+        _id, = self.backend.insert_records([sonify({'exp_id': 'exp', 'train_results': rec})])
+        put_gfs_items(self.backend, {'train_results': to_gfs}, '%s_fileitems' % _id, _id)
+        loaded = load_train_results(self.backend, list(self.backend.find({'_id': _id}))[0])
+        self.assertEqual(loaded, train_results)
+
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        buffer.append(1, {'loss': 1.0, 'first_image': np.zeros(3)})
+        self.assertEqual(len(buffer.pop('first_image')), 1)
+        self.assertEqual(buffer.pop('loss'), [1.0])
+
+
+class TestLocalBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = LocalBackend(self.root, 'testdb', 'testcol', 'exp')
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.root)
+
+    def test_records(self):
+        ids = self.backend.insert_records([{'exp_id': 'exp', 'step': i}
+                                           for i in range(3)])
+        self.assertEqual(len(set(ids)), 3)
+        recs = list(self.backend.find({'exp_id': 'exp'}))
+        self.assertEqual([rec['step'] for rec in recs], range(3))
+        self.assertEqual([rec['_id'] for rec in recs], ids)
+        with self.assertRaises(ValueError):
+            list(self.backend.find({'step': {'$gt': 0}}))
+
+    def test_checkpoints(self):
+        for step in range(4):
+            self.backend.put('data%d' % (step % 2), recent=True,
+                             exp_id='exp', saved_filters=True, step=step)
+        latest = self.backend.find_latest_checkpoint(
+                {'exp_id': 'exp', 'saved_filters': True}, recent=True)
+        self.assertEqual(latest['step'], 3)
+        self.assertIsNone(self.backend.find_latest_checkpoint(
+                {'exp_id': 'exp', 'saved_filters': True}))
+        stream = self.backend.open_download_stream(latest, recent=True)
+        self.assertEqual(stream.read(), 'data1')
+        stream.close()
+
+        self.backend.prune_recent(1)
+        recs = list(self.backend.find({'saved_filters': True}, recent=True))
+        self.assertEqual([rec['step'] for rec in recs], [3])
+        self.assertTrue(os.path.isfile(self.backend.blob_path(recs[0]['blob'])))
+
+    def test_params(self):
+        self.assertIsNone(self.backend.get_params('abc'))
+        self.backend.put_params('abc', {'a': 1})
+        self.backend.put_params('abc', {'a': 2})
+        self.assertEqual(self.backend.get_params('abc'), {'a': 1})
+
+    def test_compression(self):
+        data = 'tfutils' * 10000
+        _id = put_file(self.backend, data, compression='zlib',
+                       exp_id='exp', saved_filters=True)
+        rec = self.backend.find_latest_checkpoint({'exp_id': 'exp', 'saved_filters': True})
+        self.assertEqual(rec['_id'], _id)
+        self.assertEqual(rec['compression'], 'zlib')
+        self.assertEqual(rec['raw_length'], len(data))
+        self.assertLess(rec['length'], len(data))
+        stream = open_file(self.backend, rec)
+        self.assertEqual(stream.read(), data)
+        stream.close()
+
+    def test_gfs_items(self):
+        batches = [np.random.rand(3, 4).astype(np.float32) for _ in range(3)]
+        ids = self.backend.insert_records([{'exp_id': 'exp', 'step': i}
+                                           for i in range(3)])
+        for _id, batch in zip(ids, batches):
+            put_gfs_items(self.backend,
+                          {'validation_results': {'valid1': {'features': batch,
+                                                             'ragged': [[1], [2, 3]]}}},
+                          '%s_fileitems' % _id, _id, compression='zlib')
+
+        items = find_gfs_items(self.backend, ids[0])
+        self.assertEqual(sorted(items), ['validation_results.valid1.features',
+                                         'validation_results.valid1.ragged'])
+        item = items['validation_results.valid1.features']
+        self.assertEqual((item['dtype'], item['shape']), ('<f4', [3, 4]))
+        np.testing.assert_array_equal(load_gfs_item(self.backend, item), batches[0])
+        np.testing.assert_array_equal(
+                load_gfs_item(self.backend, item, mmap_dir=self.root), batches[0])
+        self.assertEqual(load_gfs_item(
+                self.backend, items['validation_results.valid1.ragged']), [[1], [2, 3]])
+
+        record = {'validation_results': {'valid1': {'intermediate_steps': ids}}}
+        features = load_gfs_features(self.backend, record, 'features')
+        np.testing.assert_array_equal(features, np.concatenate(batches))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,46 @@
+"""Check that importing tfutils does not load its heavy dependencies."""
+import os
+import sys
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def loaded_modules(statement, modules):
+    """Return which of ``modules`` are imported after running ``statement``."""
+    code = '%s\nimport sys\nprint(sorted(m for m in %r if m in sys.modules))' % (
+            statement, modules)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return eval(output.strip().splitlines()[-1])
+
+
+class TestLazyImports(unittest.TestCase):
+
+    heavy = ['tensorflow', 'pymongo', 'gridfs', 'git', 'pkg_resources',
+             'tfutils.model_tool', 'tfutils.model_tool_old']
+
+    def test_import_tfutils(self):
+        self.assertEqual(loaded_modules('import tfutils', self.heavy), [])
+
+    def test_import_model(self):
+        self.assertEqual(loaded_modules('from tfutils import model', self.heavy), [])
+        self.assertEqual(loaded_modules('from tfutils import model\nmodel.ConvNet_new',
+                                        ['tfutils.model_tool', 'tfutils.model_tool_old']),
+                         ['tfutils.model_tool'])
+
+    def test_import_utils(self):
+        self.assertEqual(loaded_modules('import tfutils.utils',
+                                        ['pymongo', 'gridfs', 'git', 'pkg_resources']), [])
+
+    def test_attributes(self):
+        import tfutils
+        import tfutils.base
+        self.assertIs(tfutils.train_from_params, tfutils.base.train_from_params)
+        with self.assertRaises(AttributeError):
+            tfutils.not_a_submodule
+
+
+if __name__ == '__main__':
+    unittest.main()
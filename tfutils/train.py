@@ -1,10 +1,19 @@
 from __future__ import absolute_import, division, print_function
 
+import os
+import sys
 import time
+import types
 import importlib
+import threading
+import subprocess
 import json
 import copy
 import pdb
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import tensorflow as tf
 from tensorflow.python.ops import variables
@@ -13,7 +22,7 @@ import numpy as np
 import tfutils.utils as utils
 from tfutils.error import HiLossError, NoChangeError
 from tfutils.utils import strip_prefix
-from tfutils.db_interface import DBInterface
+from tfutils.db_interface import DBInterface, step_is_due
 from tfutils.helper import \
         parse_params, get_params, \
         get_data, get_model, get_loss, \
@@ -21,7 +30,8 @@ from tfutils.helper import \
 from tfutils.validation import run_all_validations, get_valid_targets_dict
 from tfutils.defaults import \
         DEFAULT_HOST, DEFAULT_LOOP_PARAMS, \
-        DEFAULT_TRAIN_THRES_LOSS, DEFAULT_PARAMS
+        DEFAULT_TRAIN_THRES_LOSS, DEFAULT_TRAIN_STEP_TARGETS, DEFAULT_PARAMS, \
+        DEFAULT_ASYNC_VALIDATION_POLL_SECS
 
 
 def train_from_params(
@@ -45,10 +55,15 @@ def train_from_params(
             Describing the parameters used to construct the save database, and
             control saving. These include:
 
+            - backend (str, default: 'mongo')
+                Storage backend: 'mongo' (MongoDB and GridFS) or 'local' (SQLite
+                metadata and a content-addressed blob directory, no server needed)
+            - local_root (str, default: $TFUTILS_HOME/local)
+                Directory of the databases of the local backend
             - host (str)
-                Hostname where database connection lives
+                Hostname where database connection lives (mongo backend only)
             - port (int)
-                Port where database connection lives
+                Port where database connection lives (mongo backend only)
             - dbname (str)
                 Name of database for storage
             - collname (str)
@@ -93,8 +108,62 @@ def train_from_params(
             - cache_max_num (int, default: 6)
                 Maximal number of cached filters to keep in __RECENT database
             - cache_dir (str, default: None)
-                Path where caches will be saved locally. If None, will default to
+                Path where checkpoints are written before being saved. If None, will default to
                 ~/.tfutils/<host:post>/<dbname>/<collname>/<exp_id>.
+                Checkpoints loaded from the database are kept in the shared checkpoint
+                cache instead (see load_params checkpoint_cache_dir)
+            - stream_upload (bool, default: True)
+                Whether to stream checkpoint tarballs directly into GridFS instead
+                of first writing a temporary .tar file next to the checkpoint
+            - save_queue_size (int, default: 16)
+                Maximal number of save jobs waiting for the background writer.
+                Training only blocks on saving when this many jobs are pending
+                (and before saving filters, so checkpoints match their step)
+            - metrics_buffer_size (int, default: 1)
+                Number of metrics-only records to collect before writing them to
+                the database with a single insert_many. 1 writes each record at once
+            - metrics_buffer_secs (float, default: 60)
+                Maximal age in seconds of the oldest buffered metrics-only record;
+                the buffer is also flushed before any other record and on sync
+            - dedup_params (bool, default: False)
+                Whether to store the params once in the <collname>.params collection,
+                keyed by their content hash, and only put a params_id in each record.
+                DBInterface.load_from_db resolves params_id back into params
+            - ensure_indexes (bool, default: True)
+                Whether to create (if missing) the indexes on exp_id/saved_filters/uploadDate
+                and item_for used by checkpoint lookup, recent cleanup and feature readers
+            - delta_recent (bool, default: False)
+                Whether recent checkpoints only store the variables that changed since the
+                last permanent checkpoint of the run (V2 checkpoints only). Useful when most
+                variables are frozen; restoring merges the delta onto that base checkpoint
+            - snapshot_save (bool, default: False)
+                Whether to copy all saved variables to host memory with a single sess.run
+                at the save step and write the checkpoint from that copy in the background,
+                instead of running tf_saver.save on the session while training continues
+            - compression (str, default: None)
+                Codec compressing checkpoint tarballs and save_to_gfs payloads before they
+                are uploaded: 'zlib', 'bz2', or 'lzma', 'lz4', 'zstd' when installed (see
+                tfutils.compression.available_codecs). The codec and the uncompressed size
+                are recorded in the compression and raw_length fields of the file record;
+                load_from_db decompresses checkpoints transparently
+            - compression_level (int, default: None)
+                Level of the compression codec, the codec's default if None
+            - save_to_gfs_format (str, default: 'pickle')
+                How the save_to_gfs values of a record are stored: 'pickle' puts the whole
+                dict pickled in one <record id>_fileitems file, 'npy' puts each array in its
+                own .npy file with item_key, dtype and shape fields, so single features
+                can be streamed or memory-mapped. See load_gfs_item and load_gfs_features
+                in tfutils.db_interface
+            - gfs_array_threshold (int, default: None)
+                Size in bytes above which arrays in validation results are saved to GridFS
+                like the save_to_gfs keys, instead of inline in the record. None keeps
+                all arrays inline. Also applies to columnar train results
+            - train_results_format (str, default: 'list')
+                How the train results of the steps between two saves are recorded: 'list'
+                appends one dict per step to train_results, 'columnar' accumulates each
+                numeric metric in a preallocated array and records the arrays in binary,
+                with their mean, min, max and last value in train_results.summary. Use
+                load_train_results in tfutils.db_interface to get the per-step dicts back
 
         model_params (dict): Containing function that produces model and arguments to that function.
 
@@ -165,6 +234,40 @@ def train_from_params(
                 How many total steps of the optimization are run.
                 If None, train is run until process is cancelled.
 
+            - train_params['steps_per_run'] (optional, int, default: 1):
+                How many optimization steps each call of the training loop runs, to amortize
+                the per-step session and bookkeeping overhead. The loss is averaged over
+                those steps (also for thres_loss), the other train targets are from the last
+                one. Saving and validation then happen at the first run reaching or passing
+                a multiple of their frequency
+
+            - train_params['every_step_targets'] (optional, list of strings, default: None):
+                Names of the train targets fetched on every step, along with "optimizer",
+                "loss" and the internal targets. The other targets, such as those of
+                ``train_params['targets']``, are only fetched by the runs ending on a step
+                at which a record is saved. None fetches all train targets on every step
+
+            - train_params['async_validation'] (optional, bool, default: False):
+                Whether to run the validations in a separate process instead of in the
+                training session. The process builds the validation graph once the first
+                checkpoint is saved, then validates the latest checkpoint of the experiment
+                whenever its step passes a multiple of save_valid_freq, and saves the results
+                in records of the same exp_id with the step of the checkpoint (and its id in
+                "validates"). Training never waits for validation, so checkpoints
+                (cache_filters_freq) should be at least as frequent as save_valid_freq.
+                The process is a new Python interpreter receiving the pickled params, so
+                their functions must be importable (not lambdas); otherwise the
+                validations run in the training session
+
+            - train_params['minibatch_size'] (optional, int, default: the batch size):
+                Size of the minibatches whose gradients are averaged before each update
+
+            - train_params['minibatch_mode'] (optional, 'session' or 'graph', default: 'session'):
+                With 'session', the training loop runs each minibatch in its own session call.
+                With 'graph', the data provides the whole batch, which is split into
+                minibatches in the graph. They are run one after the other, their gradients
+                accumulated in flat buffers, and the update applied, all in one session call
+
         loss_params (dict): Parameters for helper.get_loss_base function to build loss.
 
             - loss_params['pred_targets'] (a string or a list of strings):
@@ -210,6 +313,21 @@ def train_from_params(
                 - Remainder of optimizer_params (aside form "optimizer") are arguments
                   to the optimizer func
 
+            - optimizer_params['aggregate_method'] (optional, 'average' or 'fused', default: 'average'):
+                How the gradients of several devices are averaged. 'fused' packs the gradients
+                of each device into flat buffers and averages those with one op each, instead
+                of a few ops per variable and device
+
+            - optimizer_params['bucket_size'] (optional, int, default: 4194304):
+                With 'fused', the largest number of elements in each flat buffer.
+                None puts all gradients of a dtype in one buffer
+
+            - optimizer_params['clip_method'], ['clip_norm'], ['fused'] (optional, with ClipOptimizer):
+                'global_norm' rescales all gradients so that their global norm is at most
+                clip_norm (default: 1.), instead of clipping each value to [-1, 1].
+                fused computes the norm over flat buffers of the gradients. The norm before
+                clipping is added to the train targets as ``global_norm``
+
             - optimizer_params['func'] (Deprecated):
                 Deprecated parameter, the same as ``optimizer_params['optimizer']``.
 
@@ -286,6 +404,15 @@ def train_from_params(
                 A dictionary whose keys are the names of the variables that are to be loaded
                 from the checkpoint, and the values are the names of the variables of the model
                 that you want to restore with the value of the corresponding checkpoint variable.
+            - stream_restore (bool, default: True)
+                Whether to extract checkpoint files directly from the GridFS download
+                stream instead of first downloading the whole .tar into the cache
+            - checkpoint_cache_dir (str, default: None)
+                Directory of the checkpoint cache shared by all jobs of the node, where
+                checkpoints are kept by _id. If None, will default to ~/.tfutils/checkpoint_cache
+            - checkpoint_cache_bytes (int, default: 20 GiB)
+                Byte budget of the checkpoint cache; least recently used checkpoints are
+                evicted beyond it. None disables eviction
 
         log_device_placement (bool, default is False): 
             Advanced parameter. Whether to log device placement in tensorflow session
@@ -311,6 +438,22 @@ def train_from_params(
                                       log_device_placement=log_device_placement,
                                       )
 
+    validation_process = None
+    async_validation = params['train_params'][0]['async_validation']
+    if async_validation and not dont_run:
+        validation_process = start_async_validation(params)
+        # params that cannot be pickled are validated inline
+        async_validation = validation_process is not None
+
+    try:
+        return _train_from_params(params, train_args, async_validation,
+                                  dont_run, log_device_placement)
+    finally:
+        if validation_process is not None:
+            stop_async_validation(validation_process)
+
+
+def _train_from_params(params, train_args, async_validation, dont_run, log_device_placement):
     with tf.Graph().as_default(), tf.device(DEFAULT_HOST):
         # For convenience, use list of dicts instead of dict of lists
         _params = [{key: value[i] for (key, value) in params.items()}
@@ -338,9 +481,12 @@ def train_from_params(
 
                 tf.get_variable_scope().reuse_variables()
 
-                trarg['validation_targets'] = \
-                        get_valid_targets_dict(
-                                **param)
+                if async_validation:
+                    trarg['validation_targets'] = {}
+                else:
+                    trarg['validation_targets'] = \
+                            get_valid_targets_dict(
+                                    **param)
 
         # Create session.
         gpu_options = tf.GPUOptions(allow_growth=True)
@@ -394,7 +540,9 @@ def train(sess,
           num_steps=float('inf'),
           thres_loss=DEFAULT_TRAIN_THRES_LOSS,
           validate_first=True,
-          validation_targets=None):
+          validation_targets=None,
+          steps_per_run=1,
+          every_step_targets=None):
     """Actually runs the training evaluation loop.
 
     Args:
@@ -404,7 +552,10 @@ def train(sess,
         dbinterface (DBInterface object): Saver through which to save results.
 
         train_loop (callable withs args: sess and train_targets):
-            Callable that specifies a custom training loop
+            Callable that specifies a custom training loop. The step of each model is
+            taken from the ``optimizer`` item of its results, which is the global step
+            after the update, and read from ``global_step`` with an extra run if the
+            loop does not return it (or ``optimizer`` is an operation)
         train_targets (dict of tensorflow nodes): Targets to train.
             One item in this dict must be "optimizer" or similar
             to make anything happen
@@ -414,6 +565,9 @@ def train(sess,
             Objects on which validation will be computed
         thres_loss (float, default: 100):
             If loss exceeds this during training, HiLossError is thrown
+        steps_per_run (int, default: 1): How many steps each call of train_loop runs.
+        every_step_targets (list of strings, default: None): The train targets
+            fetched on every step. The others are only fetched for save steps
 
     """
     # Collect args in a dict of lists
@@ -426,7 +580,9 @@ def train(sess,
         'train_targets': train_targets,
         'validate_first': validate_first,
         'num_minibatches': num_minibatches,
-        'validation_targets': validation_targets}
+        'validation_targets': validation_targets,
+        'steps_per_run': steps_per_run,
+        'every_step_targets': every_step_targets}
 
     # Convert to a list of dicts
     trargs = [{key: value[i] for (key, value) in train_args.items()}
@@ -454,17 +610,48 @@ def train(sess,
                         dbinterface=trarg['dbinterface'])
     train_loop = train_args['train_loop'][0]
     train_targets = train_args['train_targets']
+    steps_per_run = trargs[0]['steps_per_run']
+    every_step_targets = trargs[0]['every_step_targets']
+    if every_step_targets is not None:
+        step_keys = set(DEFAULT_TRAIN_STEP_TARGETS) | set(every_step_targets)
+        step_targets = [{_k: _v for _k, _v in targets.items() if _k in step_keys}
+                        for targets in train_targets]
+        # The targets of each model, by whether it saves; reused so that
+        # train_loop can cache its callables
+        run_targets = {}
 
     # Run training
     while any(step < num_step for (step, num_step) in zip(steps, num_steps)):
 
         start_time_step = time.time()
-        train_results = train_loop(sess, train_targets, num_minibatches=trarg['num_minibatches'])
-
+        loop_kwargs = {'num_minibatches': trarg['num_minibatches']}
+        if steps_per_run > 1:
+            # do not run past num_steps
+            loop_kwargs['steps_per_run'] = min(
+                    [steps_per_run] + [num_step - step for (step, num_step)
+                                       in zip(steps, num_steps) if step < num_step])
+        run_train_targets = train_targets
+        if every_step_targets is not None:
+            run_steps = loop_kwargs.get('steps_per_run', 1)
+            save_now = tuple(trarg['dbinterface'].is_save_step(step + run_steps, step)
+                             for (step, trarg) in zip(steps, trargs))
+            if save_now not in run_targets:
+                run_targets[save_now] = [
+                        targets if each_save_now else each_step_targets
+                        for (targets, each_step_targets, each_save_now)
+                        in zip(train_targets, step_targets, save_now)]
+            run_train_targets = run_targets[save_now]
+        train_results = train_loop(sess, run_train_targets, **loop_kwargs)
+
+        new_steps = []
         for (step, trarg, train_res) in zip(steps, trargs, train_results):
 
             old_step = step
-            step = trarg['global_step'].eval(session=sess)
+            step = train_res.get('optimizer')
+            if step is None:
+                # custom train_loop or optimizer not returning the step
+                step = trarg['global_step'].eval(session=sess)
+            new_steps.append(step)
 
             if step <= old_step:
                 raise NoChangeError('Your optimizer should have incremented the global step,'
@@ -474,22 +661,194 @@ def train(sess,
                                                                                      trarg['thres_loss']))
 
             # Validation
-            vtargs = trarg['validation_targets'] if step % trarg['dbinterface'].save_valid_freq == 0 else {}
-            valid_res = run_all_validations(sess, vtargs)
+            valid_now = step_is_due(step, trarg['dbinterface'].save_valid_freq, old_step)
+            valid_res = {}
+            if valid_now and trarg['validation_targets']:
+                valid_res = run_all_validations(sess, trarg['validation_targets'])
 
             # Save
             trarg['dbinterface'].start_time_step = start_time_step
             trarg['dbinterface'].save(train_res=train_res,
                                       valid_res=valid_res,
+                                      step=step,
+                                      prev_step=old_step,
                                       validation_only=False)
 
-        steps = [t['global_step'].eval(session=sess) for t in trargs]
+        steps = new_steps
 
     # Sync and close the session
     res = []
     for trarg in trargs:
-        trarg['dbinterface'].sync_with_host()
+        trarg['dbinterface'].close()
         res.append(trarg['dbinterface'].outrecs)
 
     sess.close()
     return res
+
+
+def start_async_validation(params, poll_secs=DEFAULT_ASYNC_VALIDATION_POLL_SECS):
+    """Start `async_validation` in a new Python interpreter.
+
+    This process is not forked, as its TensorFlow runtime may already be
+    running. The new process gets ``sys.path`` through PYTHONPATH, the path
+    of the main module (loaded like the main module of a multiprocessing
+    "spawn" child) as argument, and the pickled ``params`` on its stdin.
+
+    Returns:
+        subprocess.Popen: The process, to be stopped with
+            `stop_async_validation`, or None if ``params`` cannot be pickled
+            (e.g. they hold lambdas).
+
+    """
+    try:
+        payload = pickle.dumps((params, poll_secs), pickle.HIGHEST_PROTOCOL)
+    except Exception as error:
+        log.warning('Cannot pickle the params for the validation process (%s), '
+                    'validating in the training session instead.' % error)
+        return None
+    main_path = getattr(sys.modules['__main__'], '__file__', None)
+    main_path = os.path.abspath(main_path) if main_path else ''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            os.path.abspath(path) for path in sys.path))
+    process = subprocess.Popen(
+            [sys.executable, '-c',
+             'from tfutils.train import _async_validation_main; _async_validation_main()',
+             main_path],
+            stdin=subprocess.PIPE, env=env)
+    process.stdin.write(payload)
+    process.stdin.flush()
+    return process
+
+
+def stop_async_validation(process):
+    """Wait for a process of `start_async_validation` to validate the last checkpoint and exit."""
+    process.stdin.close()
+    if process.wait() != 0:
+        log.warning('The validation process exited with code %d.' % process.returncode)
+
+
+def _async_validation_main():
+    """Run `async_validation` with the params sent by `start_async_validation`.
+
+    The validation stops once the stdin of this process is closed.
+
+    """
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    main_path = sys.argv[1]
+    if main_path:
+        # The functions of the params may be defined in the main module
+        main = types.ModuleType('__mp_main__')
+        main.__file__ = main_path
+        sys.modules['__main__'] = sys.modules['__mp_main__'] = main
+        with open(main_path) as main_file:
+            code = compile(main_file.read(), main_path, 'exec')
+        exec(code, main.__dict__)
+    params, poll_secs = pickle.load(stdin)
+
+    stop_event = threading.Event()
+
+    def wait_for_stop():
+        stdin.read()
+        stop_event.set()
+
+    stop_thread = threading.Thread(target=wait_for_stop, name='tfutils-validation-stop')
+    stop_thread.daemon = True
+    stop_thread.start()
+    async_validation(params, stop_event, poll_secs)
+
+
+def async_validation(params, stop_event, poll_secs=DEFAULT_ASYNC_VALIDATION_POLL_SECS):
+    """Validate the checkpoints of a training run as they are saved.
+
+    Waits for the first checkpoint of each model, builds the validation
+    targets with the model config saved in it, then polls the latest
+    checkpoint every ``poll_secs`` seconds. Each checkpoint whose step passes
+    a multiple of save_valid_freq is restored and validated, and the results
+    saved as a validation record with that step, until ``stop_event`` is set.
+
+    Args:
+        params (dict): Parsed params of `train_from_params`, as lists over models.
+        stop_event (threading.Event): Set when training is done.
+        poll_secs (float): Seconds between two checks for new checkpoints.
+
+    """
+    _params = [{key: value[i] for (key, value) in params.items()}
+               for i in range(len(params['model_params']))]
+
+    with tf.Graph().as_default(), tf.device(DEFAULT_HOST):
+        sess = tf.Session(
+                config=tf.ConfigProto(
+                    allow_soft_placement=True,
+                    gpu_options=tf.GPUOptions(allow_growth=True),
+                    ))
+
+        vargs = []
+        try:
+            for param in _params:
+                dbinterface = DBInterface(sess=sess,
+                                          params=param,
+                                          save_params=param['save_params'],
+                                          load_params={'do_restore': True})
+                vargs.append([dbinterface, None, None, None])
+                query = {'exp_id': dbinterface.exp_id}
+                ckpt = dbinterface.load_from_db(dict(query))
+                while ckpt is None:
+                    stopping = stop_event.wait(poll_secs)
+                    # training may have saved its checkpoint since the last check
+                    ckpt = dbinterface.load_from_db(dict(query))
+                    if ckpt is None and stopping:
+                        log.warning('Training of %s ended before saving any checkpoint, '
+                                    'nothing to validate.' % dbinterface.exp_id)
+                        return
+
+                # Build the validation graph like the training one, with its config
+                saved_model_params = ckpt[0]['params']['model_params']
+                param['model_params']['seed'] = saved_model_params['seed']
+                param['model_params']['cfg_final'] = saved_model_params['cfg_final']
+                with tf.variable_scope(param['model_params']['prefix']):
+                    vargs[-1][1] = get_valid_targets_dict(**param)
+                vargs[-1][2] = -1 if param['train_params']['validate_first'] else 0
+
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+
+            # One restore Saver per model, for all its checkpoints
+            for varg in vargs:
+                dbinterface = varg[0]
+                prefix = dbinterface.params['model_params']['prefix']
+                all_vars = strip_prefix(prefix, [
+                        var for var in tf.global_variables() + tf.local_variables()
+                        if var.op.name.startswith(prefix + '/')])
+                _, ckpt_filename = dbinterface.load_from_db(
+                        {'exp_id': dbinterface.exp_id}, cache_filters=True)
+                varg[3] = tf.train.Saver(dbinterface.get_restore_vars(ckpt_filename, all_vars))
+
+            while True:
+                stopping = stop_event.is_set()
+                validated = False
+                for varg in vargs:
+                    dbinterface, validation_targets, last_step, saver = varg
+                    ckpt = dbinterface.load_from_db({'exp_id': dbinterface.exp_id})
+                    if ckpt is None or not step_is_due(ckpt[0]['step'],
+                                                       dbinterface.save_valid_freq, last_step):
+                        continue
+
+                    dbinterface.load_data = dbinterface.load_from_db(
+                            {'exp_id': dbinterface.exp_id}, cache_filters=True)
+                    rec, ckpt_filename = dbinterface.load_data
+                    log.info('Validating record %s (step %d)...' % (str(rec['_id']), rec['step']))
+                    saver.restore(sess, ckpt_filename)
+                    dbinterface.start_time_step = time.time()
+                    valid_res = run_all_validations(sess, validation_targets)
+                    dbinterface.save(valid_res=valid_res, step=rec['step'], validation_only=True)
+                    varg[2] = rec['step']
+                    validated = True
+
+                if stopping:
+                    break
+                if not validated:
+                    stop_event.wait(poll_secs)
+        finally:
+            for varg in vargs:
+                varg[0].close()
+            sess.close()
@@ -6,15 +6,12 @@ import collections
 import logging
 import json
 import inspect
-import pkg_resources
 import os
 import re
 import copy
 import pdb
 
 import numpy as np
-from bson.objectid import ObjectId
-import git
 
 import tensorflow as tf
 from tensorflow.python.client import device_lib